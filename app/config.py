@@ -1,6 +1,21 @@
 from pathlib import Path
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+
+class LLMModel(BaseModel):
+    # One OpenAI-compatible backend. Empty fields fall back to the OPENAI_*
+    # settings; context_tokens of 0 means MAP_REDUCE_CHUNK_TOKENS.
+    name: str
+    model: str = ""
+    base_url: str = ""
+    api_key: str = ""
+    context_tokens: int = 0
+    price_per_1k_prompt: float = 0.0
+    price_per_1k_completion: float = 0.0
+    max_concurrency: int = 0
+
+
 class Settings(BaseSettings):
     BASE_PATH: Path = Path(__file__).resolve().parent.parent
     LOGS_PATH: Path = BASE_PATH / "logs"
@@ -14,24 +29,127 @@ class Settings(BaseSettings):
 
     # OpenAI
     openai_api_key: str
+    openai_base_url: str = ""
+    openai_model: str = "gpt-4-turbo"
+    openai_max_concurrency: int = 8
+    openai_max_connections: int = 20
     max_request_cost: float = 1.0
     price_per_1k_prompt: float = 0.002
     price_per_1k_completion: float = 0.008
 
+    # LLM routing
+    llm_models: list[LLMModel] = []
+    llm_completion_reserve_tokens: int = 2000
+    llm_ewma_alpha: float = 0.3
+    llm_slow_latency_seconds: float = 60
+    llm_max_error_rate: float = 0.5
+    llm_cooldown_seconds: int = 60
+
+    # Streaming
+    summary_streaming_enabled: bool = False
+    stream_edit_interval_seconds: float = 1.5
+
+    # Map-reduce summarization
+    max_messages_per_request: int = 5000
+    map_reduce_chunk_tokens: int = 12000
+    map_reduce_concurrency: int = 4
+
     # Telegram
     telegram_api_id: int
     telegram_api_hash: str
+    telegram_session: str = "user_session"
+    telegram_extra_sessions: list[str] = []
+    telegram_session_concurrency: int = 4
+    telegram_flood_sleep_threshold_seconds: int = 60
     error_notification_channel_id: str = ""
+    entity_cache_ttl_seconds: int = 3600
+    entity_cache_max_size: int = 10000
+
+    # Outbound messages
+    outbound_global_rate_per_second: float = 25
+    outbound_chat_rate_per_minute: float = 20
+    outbound_chat_burst: int = 3
+    outbound_max_retries: int = 3
+    outbound_max_flood_wait_seconds: int = 60
 
     # Database
     database_url: str
+    database_pool_size: int = 10
+    database_max_overflow: int = 20
+    database_pool_timeout_seconds: int = 10
+    database_pool_recycle_seconds: int = 1800
+
+    # Message store
+    message_store_max_per_chat: int = 5000
+    token_cache_max_size: int = 100000
+
+    # Transcript compaction
+    transcript_compaction_enabled: bool = True
+    compaction_merge_window_seconds: int = 300
+    compaction_min_message_length: int = 0
+    compaction_drop_link_only: bool = False
+
+    # Summary cache
+    summary_cache_ttl_hours: int = 24
+    summary_cache_max_entries: int = 1000
+
+    # Summary archive (/find)
+    archive_search_results: int = 5
+    archive_snippet_chars: int = 300
+
+    # Job queue
+    job_workers: int = 4
+    job_poll_interval_seconds: float = 1.0
+    job_max_attempts: int = 3
+    job_retry_backoff_seconds: int = 5
+    job_stale_after_seconds: int = 600
+    job_coalesce_max_age_seconds: int = 300
+
+    # Digests
+    digest_check_interval_seconds: int = 60
+    digest_hour_utc: int = 4
+    digest_stagger_minutes: int = 60
+    digest_jitter_seconds: int = 300
+    digest_max_concurrency: int = 2
+    digest_max_messages: int = 1000
+    digest_min_every_messages: int = 50
+    digest_fresh_hours: int = 6
+
+    # Budgets in dollars per calendar day/month (UTC); 0 disables a cap
+    global_daily_budget: float = 0
+    global_monthly_budget: float = 0
+    chat_daily_budget: float = 0
+    chat_monthly_budget: float = 0
+    user_daily_budget: float = 0
+    user_monthly_budget: float = 0
+    spend_sync_interval_seconds: int = 30
+
+    # Usage analytics
+    log_retention_days: int = 30
+    usage_hourly_retention_days: int = 14
+    retention_check_interval_seconds: int = 3600
+
+    # Prompts
+    prompt_registry_check_interval_seconds: int = 30
 
     # Rate Limits
     user_request_limit_per_hour: int = 3
     thread_request_cooldown_hours: int = 6
+    rate_limit_backend: str = "memory"
+
+    # Runtime
+    embedded_bot: bool = False
+    shutdown_grace_seconds: int = 60
+    leader_lock_retry_seconds: int = 10
+
+    # Observability
+    tracing_enabled: bool = False
+    bot_metrics_host: str = "127.0.0.1"
+    bot_metrics_port: int = 9100
 
     # Timeouts
-    request_timeout_seconds: int = 30
+    # End-to-end deadline of a /summarize: history fetch, queue wait and the LLM call.
+    request_timeout_seconds: int = 300
     openai_timeout_seconds: int = 180
 
     model_config = SettingsConfigDict(env_file=BASE_PATH / ".env")
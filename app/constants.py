@@ -0,0 +1 @@
+TELEGRAM_MESSAGE_LIMIT = 4096
@@ -1,10 +1,110 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import threading
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.schema import CreateColumn
 
 from app.loader import settings
 
-engine = create_engine(settings.database_url)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ASYNC_DRIVERS = {
+    "postgres://": "postgresql+asyncpg://",
+    "postgresql://": "postgresql+asyncpg://",
+    "postgresql+psycopg2://": "postgresql+asyncpg://",
+    "sqlite://": "sqlite+aiosqlite://",
+}
+
+
+def make_async_database_url(database_url: str) -> str:
+    for prefix, async_prefix in ASYNC_DRIVERS.items():
+        if database_url.startswith(prefix):
+            return async_prefix + database_url[len(prefix) :]
+    return database_url
+
+
+def get_engine_options(database_url: str) -> dict:
+    if database_url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": settings.database_pool_size,
+        "max_overflow": settings.database_max_overflow,
+        "pool_timeout": settings.database_pool_timeout_seconds,
+        "pool_recycle": settings.database_pool_recycle_seconds,
+        "pool_pre_ping": True,
+    }
+
+
+database_url = make_async_database_url(settings.database_url)
+
+# Async connections are bound to the event loop that opened them, and the bot
+# may run its own loop next to the web server's, so each loop gets its own pool.
+_engines: dict[asyncio.AbstractEventLoop, AsyncEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine() -> AsyncEngine:
+    loop = asyncio.get_running_loop()
+    with _engines_lock:
+        engine = _engines.get(loop)
+        if engine is None:
+            engine = create_async_engine(
+                database_url, **get_engine_options(database_url)
+            )
+            _engines[loop] = engine
+        return engine
+
+
+async def dispose_engine():
+    with _engines_lock:
+        engine = _engines.pop(asyncio.get_running_loop(), None)
+    if engine is not None:
+        await engine.dispose()
+
+
+_session_factory = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+
+def SessionLocal() -> AsyncSession:
+    return _session_factory(bind=get_engine())
+
 
 Base = declarative_base()
+
+
+def add_missing_columns(connection):
+    # create_all only creates missing tables, so columns added to existing
+    # models later are added here. They must be nullable or have a server default.
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_ddl = CreateColumn(column).compile(dialect=connection.dialect)
+            connection.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}")
+            )
+
+
+def add_missing_indexes(connection):
+    # Likewise for indexes added to existing tables; create() skips indexes
+    # limited to another dialect.
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+async def init_db():
+    async with get_engine().begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(add_missing_columns)
+        await connection.run_sync(add_missing_indexes)
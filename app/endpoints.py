@@ -1,32 +1,44 @@
 from fastapi import APIRouter, Request, Depends, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database import SessionLocal
 from app.loader import templates
 from app.security import authenticate_admin
+from app.services import archive as archive_service
+from app.services import jobs as jobs_service
+from app.services import metrics
 from app.services import prompt as prompt_service
+from app.services import spend as spend_service
+from app.services import usage as usage_service
+from app.services.llm_router import llm_router
 
 router = APIRouter()
 
+ADMIN_SEARCH_RESULTS = 50
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @router.get("/", response_class=HTMLResponse)
 async def read_root(
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     _: str = Depends(authenticate_admin),
 ):
-    prompts = prompt_service.get_all_prompts(db)
+    prompts = await prompt_service.get_all_prompts(db)
+    queue_stats = await jobs_service.get_queue_stats(db)
     return templates.TemplateResponse(
-        "index.html", {"request": request, "prompts": prompts}
+        "index.html",
+        {
+            "request": request,
+            "prompts": prompts,
+            "queue_stats": queue_stats,
+            "llm_models": list(llm_router.backends),
+        },
     )
 
 
@@ -34,10 +46,11 @@ async def read_root(
 async def add_prompt(
     name: str = Form(...),
     text: str = Form(...),
-    db: Session = Depends(get_db),
+    preferred_models: str = Form(""),
+    db: AsyncSession = Depends(get_db),
     _: str = Depends(authenticate_admin),
 ):
-    prompt_service.create_prompt(db, name, text)
+    await prompt_service.create_prompt(db, name, text, preferred_models)
     return RedirectResponse(url="/", status_code=303)
 
 
@@ -45,14 +58,15 @@ async def add_prompt(
 async def edit_prompt_form(
     prompt_id: int,
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     _: str = Depends(authenticate_admin),
 ):
-    prompt = prompt_service.get_prompt_by_id(db, prompt_id)
+    prompt = await prompt_service.get_prompt_by_id(db, prompt_id)
     if not prompt:
         raise HTTPException(status_code=404, detail="Prompt not found")
     return templates.TemplateResponse(
-        "edit_prompt.html", {"request": request, "prompt": prompt}
+        "edit_prompt.html",
+        {"request": request, "prompt": prompt, "llm_models": list(llm_router.backends)},
     )
 
 
@@ -61,16 +75,101 @@ async def update_prompt(
     prompt_id: int,
     name: str = Form(...),
     text: str = Form(...),
-    db: Session = Depends(get_db),
+    preferred_models: str = Form(""),
+    db: AsyncSession = Depends(get_db),
     _: str = Depends(authenticate_admin),
 ):
-    prompt_service.update_prompt(db, prompt_id, name, text)
+    await prompt_service.update_prompt(db, prompt_id, name, text, preferred_models)
     return RedirectResponse(url="/", status_code=303)
 
 
 @router.post("/admin/prompt/delete/{prompt_id}")
 async def delete_prompt_post(
-    prompt_id: int, db: Session = Depends(get_db), _: str = Depends(authenticate_admin)
+    prompt_id: int,
+    db: AsyncSession = Depends(get_db),
+    _: str = Depends(authenticate_admin),
 ):
-    prompt_service.delete_prompt(db, prompt_id)
+    await prompt_service.delete_prompt(db, prompt_id)
     return RedirectResponse(url="/", status_code=303)
+
+
+@router.get("/admin/spend", response_class=HTMLResponse)
+async def read_spend(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    _: str = Depends(authenticate_admin),
+):
+    report = await spend_service.get_spend_report(db)
+    return templates.TemplateResponse(
+        "spend.html", {"request": request, "report": report}
+    )
+
+
+@router.get("/admin/usage", response_class=HTMLResponse)
+async def read_usage(
+    request: Request,
+    days: int = 7,
+    db: AsyncSession = Depends(get_db),
+    _: str = Depends(authenticate_admin),
+):
+    if not 1 <= days <= 366:
+        raise HTTPException(status_code=400, detail="days must be between 1 and 366")
+    report = await usage_service.get_usage_report(db, days)
+    return templates.TemplateResponse(
+        "usage.html", {"request": request, "report": report}
+    )
+
+
+@router.get("/admin/search", response_class=HTMLResponse)
+async def search_archive(
+    request: Request,
+    q: str = "",
+    chat_id: str = "",
+    prompt_name: str = "",
+    since: str = "",
+    until: str = "",
+    db: AsyncSession = Depends(get_db),
+    _: str = Depends(authenticate_admin),
+):
+    entries = None
+    if q or chat_id or prompt_name or since or until:
+        try:
+            entries = await archive_service.search_summaries(
+                db,
+                q,
+                chat_id=int(chat_id) if chat_id else None,
+                prompt_name=prompt_name or None,
+                since=archive_service.parse_day(since) if since else None,
+                until=archive_service.parse_day(until, end=True) if until else None,
+                limit=ADMIN_SEARCH_RESULTS,
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid search filters")
+    return templates.TemplateResponse(
+        "search.html",
+        {
+            "request": request,
+            "entries": entries,
+            "filters": {
+                "q": q,
+                "chat_id": chat_id,
+                "prompt_name": prompt_name,
+                "since": since,
+                "until": until,
+            },
+            "prompts": await prompt_service.get_all_prompts(db),
+        },
+    )
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics(
+    db: AsyncSession = Depends(get_db),
+    _: str = Depends(authenticate_admin),
+):
+    metrics.queue_depth.clear()
+    for status, count in (await jobs_service.get_queue_stats(db)).items():
+        metrics.queue_depth.set(count, status=status)
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
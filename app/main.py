@@ -1,12 +1,13 @@
+import asyncio
 import logging
 import threading
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from app.database import engine, Base
+from app.database import dispose_engine, init_db
 from app.endpoints import router
-from telegram_bot import run_bot
+from app.loader import settings
 
 logger = logging.getLogger(__name__)
 
@@ -14,15 +15,26 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     logger.info("Запуск FastAPI приложения...")
-    Base.metadata.create_all(bind=engine)
+    await init_db()
 
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    logger.info("Telegram-бот запущен в фоновом режиме...")
+    # The bot normally runs as its own process (python telegram_bot.py), so
+    # the admin app can be scaled with several uvicorn workers.
+    bot_thread = None
+    if settings.embedded_bot:
+        # Imported lazily: creating the Telegram client opens the session file.
+        import telegram_bot
+
+        bot_thread = threading.Thread(target=telegram_bot.run_bot, daemon=True)
+        bot_thread.start()
+        logger.info("Telegram-бот запущен в фоновом режиме...")
 
     yield
 
     logger.info("Остановка FastAPI приложения...")
+    if bot_thread is not None:
+        telegram_bot.request_shutdown()
+        await asyncio.to_thread(bot_thread.join, settings.shutdown_grace_seconds + 10)
+    await dispose_engine()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -1,7 +1,30 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, Text
+import logging
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    String,
+    Text,
+    UniqueConstraint,
+    event,
+    func,
+    literal_column,
+)
+from sqlalchemy.exc import OperationalError
 
 from app.database import Base
 
+logger = logging.getLogger(__name__)
+
+# Postgres text search configuration of the summary archive. Queries must use
+# the same expression as the index for it to be used.
+SEARCH_CONFIG = literal_column("'russian'::regconfig")
+SQLITE_SEARCH_TABLE = "tg_chats_summary_archive_fts"
+
 
 class ChatSummary(Base):
     __tablename__ = "tg_chats_summaries"
@@ -16,6 +39,8 @@ class Prompt(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True, nullable=False)
     text = Column(Text, nullable=False)
+    # Comma-separated LLM model names tried first for this prompt.
+    preferred_models = Column(String)
 
 
 class LogEntry(Base):
@@ -24,4 +49,200 @@ class LogEntry(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, index=True)
     root_post_id = Column(String, index=True)
-    called_at = Column(DateTime(timezone=True), server_default=func.now())
+    called_at = Column(DateTime(timezone=True), index=True, server_default=func.now())
+
+
+class ChatMessage(Base):
+    __tablename__ = "tg_chats_messages"
+    __table_args__ = (UniqueConstraint("chat_id", "message_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger, index=True, nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    sender_id = Column(BigInteger)
+    user = Column(String)
+    text = Column(Text, nullable=False)
+    date = Column(DateTime(timezone=True))
+
+
+class SummaryCacheEntry(Base):
+    __tablename__ = "tg_chats_summary_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(64), unique=True, index=True, nullable=False)
+    summary = Column(Text, nullable=False)
+    cost = Column(Float, nullable=False, default=0.0)
+    model = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class SummaryJob(Base):
+    __tablename__ = "tg_chats_summary_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger, index=True, nullable=False)
+    user_id = Column(String, nullable=False)
+    user_name = Column(String)
+    prompt_name = Column(String, nullable=False)
+    num_messages = Column(Integer, nullable=False)
+    last_message_id = Column(BigInteger)
+    reply_to_message_id = Column(BigInteger)
+    cache_key = Column(String(64))
+    priority = Column(Integer, nullable=False, default=0)
+    kind = Column(String, nullable=False, server_default="request")
+    trace_id = Column(String(32))
+    # Set on requests that joined an identical in-flight job and share its result.
+    coalesced_into = Column(Integer, index=True)
+    status = Column(String, index=True, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    run_after = Column(DateTime(timezone=True), server_default=func.now())
+    deadline_at = Column(DateTime(timezone=True))
+    result = Column(Text)
+    cost = Column(Float)
+    # The backend that produced the result, as chosen by the router.
+    model = Column(String)
+    last_error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+    delivered_at = Column(DateTime(timezone=True))
+
+
+class RateLimitHit(Base):
+    __tablename__ = "tg_chats_rate_limit_hits"
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String, index=True, nullable=False)
+    hit_at = Column(DateTime(timezone=True), index=True, server_default=func.now())
+
+
+class PromptVersion(Base):
+    __tablename__ = "tg_chats_prompts_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class DigestSubscription(Base):
+    __tablename__ = "tg_chats_digest_subscriptions"
+    __table_args__ = (UniqueConstraint("chat_id", "prompt_name"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger, index=True, nullable=False)
+    prompt_name = Column(String, nullable=False)
+    every_messages = Column(Integer)
+    last_message_id = Column(BigInteger)
+    next_run_at = Column(DateTime(timezone=True), index=True)
+    created_by = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Digest(Base):
+    __tablename__ = "tg_chats_digests"
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger, index=True, nullable=False)
+    prompt_name = Column(String, nullable=False)
+    summary = Column(Text, nullable=False)
+    cost = Column(Float, nullable=False, default=0.0)
+    last_message_id = Column(BigInteger)
+    created_at = Column(DateTime(timezone=True), index=True, server_default=func.now())
+
+
+class RollingSummary(Base):
+    __tablename__ = "tg_chats_rolling_summaries"
+    __table_args__ = (UniqueConstraint("chat_id", "prompt_name"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger, index=True, nullable=False)
+    prompt_name = Column(String, nullable=False)
+    summary = Column(Text, nullable=False)
+    last_message_id = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class SpendEntry(Base):
+    __tablename__ = "tg_chats_spend_ledger"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, index=True)
+    chat_id = Column(BigInteger, index=True, nullable=False)
+    user_id = Column(String, index=True)
+    prompt_name = Column(String)
+    model = Column(String)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    cost = Column(Float, nullable=False, default=0.0)
+    created_at = Column(DateTime(timezone=True), index=True, server_default=func.now())
+
+
+class UsageRollup(Base):
+    # Request counters per chat, user and prompt for each hour and day,
+    # updated as requests are served so that reports never scan raw logs.
+    __tablename__ = "tg_chats_usage_rollups"
+    __table_args__ = (
+        UniqueConstraint("period", "period_start", "chat_id", "user_id", "prompt_name"),
+        Index("ix_tg_chats_usage_rollups_period", "period", "period_start"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    period = Column(String(4), nullable=False)
+    period_start = Column(DateTime(timezone=True), nullable=False)
+    chat_id = Column(BigInteger, nullable=False)
+    user_id = Column(String, nullable=False)
+    prompt_name = Column(String, nullable=False)
+    requests = Column(Integer, nullable=False, default=0)
+    cache_hits = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
+    cost = Column(Float, nullable=False, default=0.0)
+    # Summed over requests that were not served from a cache.
+    latency_seconds = Column(Float, nullable=False, default=0.0)
+
+
+class SummaryArchiveEntry(Base):
+    __tablename__ = "tg_chats_summary_archive"
+    __table_args__ = (
+        Index("ix_tg_chats_summary_archive_chat", "chat_id", "created_at"),
+        Index(
+            "ix_tg_chats_summary_archive_search",
+            func.to_tsvector(SEARCH_CONFIG, literal_column("summary")),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer)
+    chat_id = Column(BigInteger, nullable=False)
+    prompt_name = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    user_name = Column(String)
+    summary = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), index=True, server_default=func.now())
+
+
+@event.listens_for(SummaryArchiveEntry.__table__, "after_create")
+def create_sqlite_search_table(table, connection, **kwargs):
+    # SQLite gets an FTS5 index kept in sync by triggers; without FTS5 the
+    # archive is searched with LIKE.
+    if connection.dialect.name != "sqlite":
+        return
+    statements = (
+        f"CREATE VIRTUAL TABLE {SQLITE_SEARCH_TABLE} USING fts5("
+        f"summary, content='{table.name}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER {table.name}_ai AFTER INSERT ON {table.name} BEGIN "
+        f"INSERT INTO {SQLITE_SEARCH_TABLE}(rowid, summary) "
+        "VALUES (new.id, new.summary); END",
+        f"CREATE TRIGGER {table.name}_ad AFTER DELETE ON {table.name} BEGIN "
+        f"INSERT INTO {SQLITE_SEARCH_TABLE}({SQLITE_SEARCH_TABLE}, rowid, summary) "
+        "VALUES ('delete', old.id, old.summary); END",
+    )
+    try:
+        connection.exec_driver_sql(statements[0])
+    except OperationalError as e:
+        logger.warning(
+            f"FTS5 недоступен, поиск по архиву сводок будет без индекса: {e}"
+        )
+        return
+    for statement in statements[1:]:
+        connection.exec_driver_sql(statement)
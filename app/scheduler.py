@@ -0,0 +1,149 @@
+import asyncio
+import logging
+
+from app.database import SessionLocal
+from app.loader import settings
+from app.models import DigestSubscription
+from app.services import digests as digests_service
+from app.services import jobs as jobs_service
+from app.services import message_store
+from app.services import prompt as prompt_service
+from app.services import spend as spend_service
+from app.services import usage as usage_service
+from app.services.llm_router import llm_router
+from app.services.summary_cache import make_cache_key
+from app.services.transcript import build_transcript
+
+logger = logging.getLogger(__name__)
+
+
+class DigestScheduler:
+    def __init__(self, bot):
+        self.bot = bot
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка в планировщике дайджестов")
+            await asyncio.sleep(settings.digest_check_interval_seconds)
+
+    async def run_once(self):
+        async with SessionLocal() as db:
+            active = await jobs_service.count_active_jobs(db, jobs_service.KIND_DIGEST)
+            free_slots = settings.digest_max_concurrency - active
+            if free_slots <= 0:
+                return
+
+            due = await digests_service.get_due_subscriptions(db)
+            for index, subscription in enumerate(due[:free_slots]):
+                if index:
+                    # Chats are synced one at a time to stay clear of FloodWait.
+                    await asyncio.sleep(digests_service.get_jitter_seconds() / 10)
+                await self._schedule(db, subscription)
+
+    async def _schedule(self, db, subscription: DigestSubscription):
+        prompt = await prompt_service.prompt_registry.get(db, subscription.prompt_name)
+        if not prompt:
+            logger.warning(
+                f"Дайджест чата {subscription.chat_id}: промпт "
+                f"'{subscription.prompt_name}' не найден"
+            )
+            await digests_service.mark_scheduled(db, subscription, None)
+            return
+
+        budget_error = await spend_service.spend_tracker.check(
+            db, subscription.chat_id, subscription.created_by
+        )
+        if budget_error:
+            logger.warning(
+                f"Дайджест чата {subscription.chat_id} пропущен: {budget_error}"
+            )
+            await digests_service.mark_scheduled(db, subscription, None)
+            return
+
+        messages = await message_store.sync_chat_history(
+            self.bot, db, subscription.chat_id, settings.digest_max_messages
+        )
+        if subscription.last_message_id is not None:
+            messages = [
+                msg for msg in messages if msg["id"] > subscription.last_message_id
+            ]
+        if not messages:
+            await digests_service.mark_scheduled(db, subscription, None)
+            return
+
+        transcript = build_transcript(subscription.chat_id, messages)
+        await jobs_service.enqueue_job(
+            db,
+            chat_id=subscription.chat_id,
+            user_id=subscription.created_by,
+            user_name=None,
+            prompt_name=prompt.name,
+            num_messages=len(messages),
+            last_message_id=messages[-1]["id"],
+            reply_to_message_id=None,
+            cache_key=make_cache_key(
+                transcript.text,
+                prompt.text,
+                llm_router.routing_key(prompt.preferred_models),
+            ),
+            priority=jobs_service.PRIORITY_BACKGROUND,
+            kind=jobs_service.KIND_DIGEST,
+            delay_seconds=digests_service.get_jitter_seconds(),
+        )
+        await digests_service.mark_scheduled(db, subscription, messages[-1]["id"])
+        logger.info(
+            f"Запланирован дайджест чата {subscription.chat_id} "
+            f"по {len(messages)} сообщениям"
+        )
+
+
+class RetentionScheduler:
+    # Prunes raw request logs and old hourly rollups; only the bot process
+    # runs it, as it holds the leader lock.
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                async with SessionLocal() as db:
+                    log_entries, hourly_rollups = await usage_service.prune_usage_data(
+                        db
+                    )
+                if log_entries or hourly_rollups:
+                    logger.info(
+                        f"Удалено старых записей журнала: {log_entries}, "
+                        f"почасовых сводок статистики: {hourly_rollups}"
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка при очистке журнала запросов")
+            await asyncio.sleep(settings.retention_check_interval_seconds)
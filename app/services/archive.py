@@ -0,0 +1,161 @@
+import re
+from datetime import datetime, UTC, timedelta
+
+from sqlalchemy import column, func, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import (
+    SEARCH_CONFIG,
+    SQLITE_SEARCH_TABLE,
+    SummaryArchiveEntry,
+    SummaryJob,
+)
+from app.services import metrics
+
+FILTER_PATTERN = re.compile(r"^(prompt|days|since|until):(\S+)$")
+WORD_PATTERN = re.compile(r"\w+")
+
+sqlite_search_table = table(
+    SQLITE_SEARCH_TABLE, column("rowid"), column("summary"), column("rank")
+)
+# Whether the SQLite FTS5 table exists; checked once per process.
+_sqlite_fts_available: bool | None = None
+
+
+async def archive_summary(db: AsyncSession, job: SummaryJob):
+    db.add(
+        SummaryArchiveEntry(
+            job_id=job.id,
+            chat_id=job.chat_id,
+            prompt_name=job.prompt_name,
+            kind=job.kind,
+            user_name=job.user_name,
+            summary=job.result,
+            created_at=datetime.now(UTC),
+        )
+    )
+    await db.commit()
+
+
+def parse_day(value: str, end: bool = False) -> datetime:
+    # A YYYY-MM-DD date as the start of that UTC day, or of the next one
+    # when it ends a range.
+    day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=UTC)
+    return day + timedelta(days=1) if end else day
+
+
+def parse_search_filters(words: list[str]) -> tuple[str, dict]:
+    # Splits "/find" arguments into the query text and prompt:, days:,
+    # since: and until: filters. Raises ValueError on a malformed filter.
+    query_words = []
+    filters = {}
+    for word in words:
+        match = FILTER_PATTERN.match(word)
+        if match is None:
+            query_words.append(word)
+            continue
+        name, value = match.groups()
+        if name == "prompt":
+            filters["prompt_name"] = value
+        elif name == "days":
+            filters["since"] = datetime.now(UTC) - timedelta(days=int(value))
+        elif name == "since":
+            filters["since"] = parse_day(value)
+        else:
+            filters["until"] = parse_day(value, end=True)
+    return " ".join(query_words), filters
+
+
+async def _has_sqlite_fts(db: AsyncSession) -> bool:
+    global _sqlite_fts_available
+    if _sqlite_fts_available is None:
+        _sqlite_fts_available = bool(
+            await db.scalar(
+                select(column("name"))
+                .select_from(table("sqlite_master"))
+                .where(column("name") == SQLITE_SEARCH_TABLE)
+            )
+        )
+    return _sqlite_fts_available
+
+
+def _fts5_query(text: str) -> str:
+    # Every word must occur, as a prefix so that Russian word endings vary.
+    return " ".join(f'"{word}"*' for word in WORD_PATTERN.findall(text))
+
+
+async def search_summaries(
+    db: AsyncSession,
+    text: str,
+    chat_id: int | None = None,
+    prompt_name: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    limit: int | None = None,
+) -> list[SummaryArchiveEntry]:
+    query = select(SummaryArchiveEntry)
+    if chat_id is not None:
+        query = query.where(SummaryArchiveEntry.chat_id == chat_id)
+    if prompt_name:
+        query = query.where(SummaryArchiveEntry.prompt_name == prompt_name)
+    if since is not None:
+        query = query.where(SummaryArchiveEntry.created_at >= since)
+    if until is not None:
+        query = query.where(SummaryArchiveEntry.created_at < until)
+
+    dialect = db.get_bind().dialect.name
+    if not WORD_PATTERN.search(text):
+        order_by = []
+    elif dialect == "postgresql":
+        vector = func.to_tsvector(SEARCH_CONFIG, SummaryArchiveEntry.summary)
+        search_query = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+        query = query.where(vector.op("@@")(search_query))
+        order_by = [func.ts_rank(vector, search_query).desc()]
+    elif dialect == "sqlite" and await _has_sqlite_fts(db):
+        query = query.join(
+            sqlite_search_table,
+            sqlite_search_table.c.rowid == SummaryArchiveEntry.id,
+        ).where(sqlite_search_table.c.summary.op("MATCH")(_fts5_query(text)))
+        order_by = [sqlite_search_table.c.rank]
+    else:
+        for word in WORD_PATTERN.findall(text):
+            query = query.where(SummaryArchiveEntry.summary.ilike(f"%{word}%"))
+        order_by = []
+
+    entries = (
+        await db.scalars(
+            query.order_by(*order_by, SummaryArchiveEntry.created_at.desc()).limit(
+                limit or settings.archive_search_results
+            )
+        )
+    ).all()
+    metrics.cache_requests.inc(cache="archive", result="hit" if entries else "miss")
+    return entries
+
+
+def make_snippet(summary: str, text: str, length: int | None = None) -> str:
+    # A window of the summary around the first query word found in it.
+    length = length or settings.archive_snippet_chars
+    lowered = summary.lower()
+    positions = [
+        position
+        for word in WORD_PATTERN.findall(text.lower())
+        if (position := lowered.find(word)) != -1
+    ]
+    start = max(0, min(positions, default=0) - length // 3)
+    snippet = summary[start : start + length].strip()
+    if start > 0:
+        snippet = "…" + snippet
+    if start + length < len(summary):
+        snippet += "…"
+    return snippet
+
+
+def format_search_results(entries: list[SummaryArchiveEntry], text: str) -> str:
+    results = [
+        f"**{entry.created_at:%Y-%m-%d %H:%M} UTC · {entry.prompt_name}**\n"
+        f"{make_snippet(entry.summary, text)}"
+        for entry in entries
+    ]
+    return "🔎 **Найдено в архиве сводок:**\n\n" + "\n\n".join(results)
@@ -0,0 +1,35 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, ttl_seconds: int, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return None
+
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (value, time.monotonic() + self.ttl_seconds)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        item = self._items.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        self._items.clear()
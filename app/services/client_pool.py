@@ -0,0 +1,224 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from functools import wraps
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from app.loader import settings
+from app.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Points per session on the hash ring; more points spread chats more evenly.
+RING_REPLICAS = 64
+# Marked ids of supergroups and channels are below this value.
+CHANNEL_ID_LIMIT = -(10**12)
+
+
+def configured_sessions() -> list[str]:
+    return [settings.telegram_session, *settings.telegram_extra_sessions]
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest())
+
+
+def shares_message_ids(chat) -> bool:
+    # Supergroups and channels number messages per chat, so every account sees
+    # the same ids. Basic groups and private chats number them per account:
+    # ids stored or replied to by one account mean nothing to another one.
+    return isinstance(chat, int) and chat < CHANNEL_ID_LIMIT
+
+
+class PooledClient:
+    def __init__(self, name: str, client: TelegramClient):
+        self.name = name
+        self.client = client
+        self.semaphore = asyncio.Semaphore(settings.telegram_session_concurrency)
+        self.cooldown_until = 0.0
+
+    @property
+    def cooldown_left(self) -> float:
+        return max(0.0, self.cooldown_until - time.monotonic())
+
+    def cool_down(self, seconds: float):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+        metrics.telegram_flood_waits.inc(session=self.name)
+
+
+class ClientPool:
+    # Several user accounts serve the bot together. Each supergroup is
+    # assigned to one account by consistent hashing, so adding an account
+    # moves only its share of chats, and that account handles the group's
+    # updates and requests. Calls run under a per-account concurrency limit;
+    # when the account gets a FloodWait, calls move to the next account on
+    # the ring until it cools down. Basic groups and private chats stay on
+    # the first account: their message ids, which the store and the summary
+    # cursors keep, would change with the account.
+
+    def __init__(self, clients: dict[str, TelegramClient]):
+        self.members = [PooledClient(name, client) for name, client in clients.items()]
+        self._ring = sorted(
+            (_ring_hash(f"{member.name}#{replica}"), index)
+            for index, member in enumerate(self.members)
+            for replica in range(RING_REPLICAS)
+        )
+        self._ring_keys = [key for key, _ in self._ring]
+
+    @property
+    def primary(self) -> PooledClient:
+        return self.members[0]
+
+    @property
+    def session_names(self) -> list[str]:
+        return [member.name for member in self.members]
+
+    def _ring_order(self, chat) -> list[PooledClient]:
+        if not shares_message_ids(chat) or len(self.members) == 1:
+            return [self.primary]
+        start = bisect.bisect(self._ring_keys, _ring_hash(str(chat)))
+        order = []
+        for offset in range(len(self._ring)):
+            member = self.members[self._ring[(start + offset) % len(self._ring)][1]]
+            if member not in order:
+                order.append(member)
+                if len(order) == len(self.members):
+                    break
+        return order
+
+    def owner(self, chat) -> PooledClient:
+        return self._ring_order(chat)[0]
+
+    async def _call(
+        self,
+        members: list[PooledClient],
+        sleep_threshold: float,
+        method: str,
+        *args,
+        **kwargs,
+    ):
+        # Tries the accounts in ring order, skipping those in a FloodWait.
+        # When all of them wait, waits up to sleep_threshold are slept
+        # through like Telethon does on its own; longer ones reach the caller.
+        while True:
+            last_error = None
+            for member in members:
+                if member.cooldown_left:
+                    continue
+                try:
+                    async with member.semaphore:
+                        return await getattr(member.client, method)(*args, **kwargs)
+                except FloodWaitError as e:
+                    member.cool_down(e.seconds)
+                    last_error = e
+                    if len(members) > 1:
+                        logger.warning(
+                            f"FloodWait {e.seconds}s у сессии '{member.name}', "
+                            f"запрос {method} передан другой сессии"
+                        )
+
+            wait = min(member.cooldown_left for member in members)
+            if wait > sleep_threshold:
+                if last_error is None:
+                    last_error = FloodWaitError(request=None, capture=int(wait) + 1)
+                raise last_error
+            await asyncio.sleep(wait)
+
+    async def get_messages(self, chat, *args, **kwargs):
+        return await self._call(
+            self._ring_order(chat),
+            settings.telegram_flood_sleep_threshold_seconds,
+            "get_messages",
+            chat,
+            *args,
+            **kwargs,
+        )
+
+    # Sends never sleep here: the outbound scheduler paces and retries them
+    # on FloodWait once no other account can take them.
+
+    async def send_message(self, chat, *args, **kwargs):
+        return await self._call(
+            self._ring_order(chat), 0, "send_message", chat, *args, **kwargs
+        )
+
+    async def edit_message(self, chat, message, *args, **kwargs):
+        # Only the account that sent a message can edit it.
+        members = [
+            member
+            for member in self.members
+            if member.client is getattr(message, "client", None)
+        ] or [self.owner(chat)]
+        return await self._call(
+            members, 0, "edit_message", chat, message, *args, **kwargs
+        )
+
+    async def get_entity(self, entity):
+        # Access hashes are per account, so an entity unknown to one session
+        # may still be resolved by another.
+        last_error = None
+        for member in self.members:
+            try:
+                return await self._call(
+                    [member],
+                    settings.telegram_flood_sleep_threshold_seconds,
+                    "get_entity",
+                    entity,
+                )
+            except ValueError as e:
+                last_error = e
+        raise last_error
+
+    def on(self, event):
+        def decorator(func):
+            for member in self.members:
+                member.client.add_event_handler(self._owned_by(member, func), event)
+            return func
+
+        return decorator
+
+    def _owned_by(self, member: PooledClient, func):
+        # Every account in a chat receives its updates; only the owner acts
+        # on them, so commands are answered once.
+        @wraps(func)
+        async def handler(event):
+            if self.owner(event.chat_id) is member:
+                return await func(event)
+
+        return handler
+
+    async def start(self):
+        # Sequential, since a session without an authorization asks for the
+        # phone number and code on the console.
+        for member in self.members:
+            await member.client.start()
+            logger.info(f"Сессия Telegram '{member.name}' запущена")
+
+    async def wait_disconnected(self):
+        await asyncio.wait(
+            [member.client.disconnected for member in self.members],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+
+    async def disconnect(self):
+        await asyncio.gather(*(member.client.disconnect() for member in self.members))
+
+
+def create_client_pool() -> ClientPool:
+    # Telethon would sleep through short FloodWaits itself and keep the call
+    # on the busy account; the pool handles them to fail over instead.
+    return ClientPool(
+        {
+            name: TelegramClient(
+                name,
+                settings.telegram_api_id,
+                settings.telegram_api_hash,
+                flood_sleep_threshold=0,
+            )
+            for name in configured_sessions()
+        }
+    )
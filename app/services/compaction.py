@@ -0,0 +1,122 @@
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from app.loader import settings
+
+URL_PATTERN = re.compile(r"(?:https?://|t\.me/|www\.)\S+", re.IGNORECASE)
+
+
+@dataclass
+class CompactEntry:
+    prefix: str
+    messages: list[dict] = field(default_factory=list)
+
+    @property
+    def line(self) -> str:
+        return self.prefix + "\n".join(msg["text"] for msg in self.messages) + "\n"
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+def is_link_only(text: str) -> bool:
+    return bool(URL_PATTERN.search(text)) and not URL_PATTERN.sub("", text).strip()
+
+
+def sender_key(msg: dict):
+    return msg["sender_id"] if msg["sender_id"] is not None else msg["user"]
+
+
+def filter_messages(
+    messages: list[dict],
+    min_length: int = settings.compaction_min_message_length,
+    drop_links: bool = settings.compaction_drop_link_only,
+    repeat_window_seconds: int = settings.compaction_merge_window_seconds,
+) -> list[dict]:
+    # Only a sender repeating their own text within the window counts as a
+    # repeat (double sends, spam). The same short answer from someone else,
+    # or to a later question, carries meaning and is kept.
+    last_said: dict[tuple, datetime] = {}
+    kept = []
+    for msg in messages:
+        normalized = normalize_text(msg["text"] or "")
+        if not normalized or len(normalized) < min_length:
+            continue
+        if drop_links and is_link_only(normalized):
+            continue
+        date = datetime.fromisoformat(msg["date"])
+        key = (sender_key(msg), normalized)
+        previous = last_said.get(key)
+        last_said[key] = date
+        if (
+            previous is not None
+            and (date - previous).total_seconds() <= repeat_window_seconds
+        ):
+            continue
+        kept.append(msg)
+    return kept
+
+
+def assign_aliases(messages: list[dict]) -> dict:
+    aliases = {}
+    for msg in messages:
+        sender = sender_key(msg)
+        if sender not in aliases:
+            aliases[sender] = (f"U{len(aliases) + 1}", msg["user"])
+    return aliases
+
+
+def format_gap(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return ""
+    if minutes < 60:
+        return f"[+{minutes}м] "
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"[+{hours}ч{minutes}м] " if minutes else f"[+{hours}ч] "
+    return f"[+{hours // 24}д] "
+
+
+def compact_messages(messages: list[dict]) -> tuple[str, list[CompactEntry]]:
+    # Aliases come from all messages, so a participant whose messages were
+    # all filtered out is still listed.
+    aliases = assign_aliases(messages)
+    messages = filter_messages(messages)
+    if not messages:
+        return "", []
+
+    entries = []
+    last_sender = None
+    last_date = None
+
+    for msg in messages:
+        sender = sender_key(msg)
+        date = datetime.fromisoformat(msg["date"])
+        gap = (date - last_date).total_seconds() if last_date else 0
+
+        if (
+            entries
+            and sender == last_sender
+            and gap <= settings.compaction_merge_window_seconds
+        ):
+            entries[-1].messages.append(msg)
+        else:
+            entries.append(
+                CompactEntry(prefix=f"{format_gap(gap)}{aliases[sender][0]}: ")
+            )
+            entries[-1].messages.append(msg)
+
+        last_sender = sender
+        last_date = date
+
+    participants = ", ".join(f"{alias} — {name}" for alias, name in aliases.values())
+    started_at = datetime.fromisoformat(messages[0]["date"])
+    header = (
+        f"Участники: {participants}\n"
+        f"Начало переписки: {started_at:%Y-%m-%d %H:%M} UTC. "
+        f"В скобках указано время с предыдущего сообщения.\n---\n"
+    )
+    return header, entries
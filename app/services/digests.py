@@ -0,0 +1,149 @@
+import random
+from datetime import datetime, UTC, timedelta
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import ChatMessage, Digest, DigestSubscription, SummaryJob
+
+
+def get_stagger_offset(chat_id: int) -> timedelta:
+    # A stable per-chat offset spreads daily digests over the stagger window
+    # instead of starting them all at digest_hour_utc.
+    window_seconds = settings.digest_stagger_minutes * 60
+    if window_seconds <= 0:
+        return timedelta()
+    return timedelta(seconds=(chat_id * 2654435761) % window_seconds)
+
+
+def get_jitter_seconds() -> float:
+    return random.uniform(0, settings.digest_jitter_seconds)
+
+
+def next_daily_run(chat_id: int, now_utc: datetime) -> datetime:
+    run_at = now_utc.replace(
+        hour=settings.digest_hour_utc, minute=0, second=0, microsecond=0
+    ) + get_stagger_offset(chat_id)
+    while run_at <= now_utc:
+        run_at += timedelta(days=1)
+    return run_at
+
+
+async def get_subscription(
+    db: AsyncSession, chat_id: int, prompt_name: str
+) -> DigestSubscription | None:
+    return await db.scalar(
+        select(DigestSubscription).where(
+            DigestSubscription.chat_id == chat_id,
+            DigestSubscription.prompt_name == prompt_name,
+        )
+    )
+
+
+async def get_chat_subscriptions(
+    db: AsyncSession, chat_id: int
+) -> list[DigestSubscription]:
+    subscriptions = await db.scalars(
+        select(DigestSubscription).where(DigestSubscription.chat_id == chat_id)
+    )
+    return subscriptions.all()
+
+
+async def subscribe(
+    db: AsyncSession,
+    chat_id: int,
+    prompt_name: str,
+    created_by: str,
+    every_messages: int | None = None,
+) -> DigestSubscription:
+    subscription = await get_subscription(db, chat_id, prompt_name)
+    if subscription is None:
+        subscription = DigestSubscription(chat_id=chat_id, prompt_name=prompt_name)
+        db.add(subscription)
+
+    subscription.every_messages = every_messages
+    subscription.created_by = created_by
+    subscription.next_run_at = (
+        None if every_messages else next_daily_run(chat_id, datetime.now(UTC))
+    )
+    await db.commit()
+    return subscription
+
+
+async def unsubscribe(db: AsyncSession, chat_id: int, prompt_name: str | None) -> int:
+    query = delete(DigestSubscription).where(DigestSubscription.chat_id == chat_id)
+    if prompt_name:
+        query = query.where(DigestSubscription.prompt_name == prompt_name)
+    result = await db.execute(query)
+    await db.commit()
+    return result.rowcount
+
+
+async def count_new_messages(db: AsyncSession, subscription: DigestSubscription) -> int:
+    query = select(func.count(ChatMessage.id)).where(
+        ChatMessage.chat_id == subscription.chat_id
+    )
+    if subscription.last_message_id is not None:
+        query = query.where(ChatMessage.message_id > subscription.last_message_id)
+    return await db.scalar(query)
+
+
+async def get_due_subscriptions(db: AsyncSession) -> list[DigestSubscription]:
+    now_utc = datetime.now(UTC)
+    due = (
+        await db.scalars(
+            select(DigestSubscription)
+            .where(DigestSubscription.next_run_at <= now_utc)
+            .order_by(DigestSubscription.next_run_at)
+        )
+    ).all()
+
+    by_messages = await db.scalars(
+        select(DigestSubscription).where(DigestSubscription.every_messages.is_not(None))
+    )
+    for subscription in by_messages:
+        if await count_new_messages(db, subscription) >= subscription.every_messages:
+            due.append(subscription)
+    return due
+
+
+async def mark_scheduled(
+    db: AsyncSession, subscription: DigestSubscription, last_message_id: int | None
+):
+    if last_message_id is not None:
+        subscription.last_message_id = last_message_id
+    if subscription.every_messages is None:
+        subscription.next_run_at = next_daily_run(
+            subscription.chat_id, datetime.now(UTC)
+        )
+    await db.commit()
+
+
+async def store_digest(db: AsyncSession, job: SummaryJob):
+    db.add(
+        Digest(
+            chat_id=job.chat_id,
+            prompt_name=job.prompt_name,
+            summary=job.result,
+            cost=job.cost,
+            last_message_id=job.last_message_id,
+        )
+    )
+    await db.commit()
+
+
+async def get_fresh_digest(
+    db: AsyncSession, chat_id: int, prompt_name: str
+) -> Digest | None:
+    fresh_since = datetime.now(UTC) - timedelta(hours=settings.digest_fresh_hours)
+    return await db.scalar(
+        select(Digest)
+        .where(
+            Digest.chat_id == chat_id,
+            Digest.prompt_name == prompt_name,
+            Digest.created_at >= fresh_since,
+        )
+        .order_by(Digest.created_at.desc())
+        .limit(1)
+    )
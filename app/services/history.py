@@ -0,0 +1,97 @@
+import logging
+
+from app.loader import settings
+from app.services import metrics
+from app.services.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+sender_cache = TTLCache(
+    ttl_seconds=settings.entity_cache_ttl_seconds,
+    max_size=settings.entity_cache_max_size,
+)
+
+
+def get_display_name(entity) -> str:
+    if entity is None:
+        return "Unknown"
+    return (
+        getattr(entity, "username", None)
+        or getattr(entity, "first_name", None)
+        or getattr(entity, "title", None)
+        or "Unknown"
+    )
+
+
+async def resolve_sender_names(bot, chat_id: int, messages) -> dict[int, str]:
+    with metrics.stage_seconds.time(stage="sender_resolution"):
+        return await _resolve_sender_names(bot, chat_id, messages)
+
+
+async def _resolve_sender_names(bot, chat_id: int, messages) -> dict[int, str]:
+    names = {}
+    missing = set()
+
+    for message in messages:
+        sender_id = message.sender_id
+        if sender_id is None or sender_id in names:
+            continue
+
+        cached = sender_cache.get((chat_id, sender_id))
+        metrics.cache_requests.inc(
+            cache="sender", result="miss" if cached is None else "hit"
+        )
+        if cached is not None:
+            names[sender_id] = cached
+        elif message.sender is not None:
+            names[sender_id] = get_display_name(message.sender)
+            sender_cache.set((chat_id, sender_id), names[sender_id])
+        else:
+            missing.add(sender_id)
+
+    if missing:
+        missing_ids = list(missing)
+        try:
+            entities = await bot.get_entity(missing_ids)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Не удалось получить отправителей {missing_ids}: {e}")
+            entities = [None] * len(missing_ids)
+
+        for sender_id, entity in zip(missing_ids, entities):
+            names[sender_id] = get_display_name(entity)
+            sender_cache.set((chat_id, sender_id), names[sender_id])
+
+    return names
+
+
+def to_compact_message(message, user: str) -> dict:
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "user": user,
+        "text": message.text,
+        "date": message.date.isoformat(),
+    }
+
+
+async def fetch_history_page(
+    bot, chat_id: int, limit: int, **kwargs
+) -> tuple[list[dict], bool]:
+    # The flag tells whether Telegram returned a full page, i.e. whether more
+    # messages may be left in the requested range. Messages without text are
+    # dropped afterwards, so the length of the list cannot tell that.
+    with metrics.stage_seconds.time(stage="history_fetch"):
+        messages = await bot.get_messages(chat_id, limit=limit, **kwargs)
+    full = len(messages) >= limit
+    messages = [message for message in reversed(messages) if message.text]
+
+    names = await resolve_sender_names(bot, chat_id, messages)
+    return [
+        to_compact_message(message, names.get(message.sender_id, "Unknown"))
+        for message in messages
+    ], full
+
+
+async def fetch_history(bot, chat_id: int, limit: int, **kwargs) -> list[dict]:
+    messages, _ = await fetch_history_page(bot, chat_id, limit, **kwargs)
+    return messages
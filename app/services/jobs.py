@@ -0,0 +1,366 @@
+from datetime import datetime, UTC, timedelta
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import SummaryJob
+from app.services import metrics
+from app.services.openai import SummaryResponse
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_WAITING = "waiting"
+JOB_CANCELLED = "cancelled"
+
+PRIORITY_INTERACTIVE = 10
+PRIORITY_BACKGROUND = 0
+
+KIND_REQUEST = "request"
+KIND_DIGEST = "digest"
+KIND_ROLLING = "rolling"
+
+
+async def enqueue_job(
+    db: AsyncSession,
+    chat_id: int,
+    user_id: str,
+    user_name: str,
+    prompt_name: str,
+    num_messages: int,
+    last_message_id: int,
+    reply_to_message_id: int,
+    cache_key: str,
+    priority: int = PRIORITY_INTERACTIVE,
+    kind: str = KIND_REQUEST,
+    delay_seconds: float = 0,
+    trace_id: str | None = None,
+    deadline_at: datetime | None = None,
+) -> SummaryJob:
+    job = SummaryJob(
+        chat_id=chat_id,
+        user_id=user_id,
+        user_name=user_name,
+        prompt_name=prompt_name,
+        num_messages=num_messages,
+        last_message_id=last_message_id,
+        reply_to_message_id=reply_to_message_id,
+        cache_key=cache_key,
+        priority=priority,
+        kind=kind,
+        trace_id=trace_id,
+        status=JOB_PENDING,
+        attempts=0,
+        run_after=datetime.now(UTC) + timedelta(seconds=delay_seconds),
+        deadline_at=deadline_at,
+    )
+    db.add(job)
+    await db.commit()
+    return job
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value
+
+
+def time_left(job: SummaryJob) -> float | None:
+    # Seconds until the job's deadline; None for jobs without one (digests).
+    if job.deadline_at is None:
+        return None
+    return (_as_utc(job.deadline_at) - datetime.now(UTC)).total_seconds()
+
+
+def job_latency(job: SummaryJob) -> float:
+    # What the requester waited for; for background digests only the run
+    # itself, since they are scheduled with a deliberate delay.
+    if job.kind == KIND_DIGEST:
+        started_at = job.started_at or job.created_at
+    else:
+        started_at = job.created_at
+    return (datetime.now(UTC) - _as_utc(started_at)).total_seconds()
+
+
+async def find_coalescable_job(
+    db: AsyncSession, chat_id: int, prompt_name: str, kind: str, num_messages: int
+) -> SummaryJob | None:
+    query = select(SummaryJob).where(
+        SummaryJob.chat_id == chat_id,
+        SummaryJob.prompt_name == prompt_name,
+        SummaryJob.kind == kind,
+        SummaryJob.status.in_((JOB_PENDING, JOB_RUNNING)),
+        SummaryJob.coalesced_into.is_(None),
+        SummaryJob.created_at
+        >= datetime.now(UTC) - timedelta(seconds=settings.job_coalesce_max_age_seconds),
+    )
+    # Rolling summaries always cover everything since the stored one.
+    if kind != KIND_ROLLING:
+        query = query.where(SummaryJob.num_messages == num_messages)
+    return await db.scalar(query.order_by(SummaryJob.id.desc()).limit(1))
+
+
+async def join_job(
+    db: AsyncSession,
+    leader: SummaryJob,
+    user_id: str,
+    user_name: str,
+    reply_to_message_id: int,
+    trace_id: str | None = None,
+) -> SummaryJob:
+    job = SummaryJob(
+        chat_id=leader.chat_id,
+        user_id=user_id,
+        user_name=user_name,
+        prompt_name=leader.prompt_name,
+        num_messages=leader.num_messages,
+        last_message_id=leader.last_message_id,
+        reply_to_message_id=reply_to_message_id,
+        priority=leader.priority,
+        kind=leader.kind,
+        trace_id=trace_id,
+        coalesced_into=leader.id,
+        status=JOB_WAITING,
+        attempts=0,
+    )
+    db.add(job)
+    await db.commit()
+    # The leader may have finished while this request was joining it.
+    await resolve_followers(db, leader.id)
+    return job
+
+
+async def resolve_followers(db: AsyncSession, leader_id: int):
+    leader = await db.get(SummaryJob, leader_id, populate_existing=True)
+    if leader is None or leader.status not in (
+        JOB_COMPLETED,
+        JOB_FAILED,
+        JOB_CANCELLED,
+    ):
+        return
+
+    followers = await db.scalars(
+        select(SummaryJob).where(
+            SummaryJob.coalesced_into == leader.id,
+            SummaryJob.status == JOB_WAITING,
+        )
+    )
+    now_utc = datetime.now(UTC)
+    for follower in followers:
+        follower.status = leader.status
+        follower.finished_at = now_utc
+        if leader.status == JOB_COMPLETED:
+            # The summary was paid for by the leader's request.
+            follower.result = leader.result
+            follower.cost = 0.0
+            follower.model = leader.model
+        elif leader.status == JOB_CANCELLED:
+            follower.status = JOB_FAILED
+            follower.last_error = (
+                f"@{follower.user_name}, запрос, к которому присоединился ваш, "
+                "был отменён. Повторите /summarize."
+            )
+        else:
+            follower.last_error = (leader.last_error or "").replace(
+                f"@{leader.user_name}", f"@{follower.user_name}", 1
+            )
+    await db.commit()
+
+
+async def count_jobs_ahead(db: AsyncSession, job: SummaryJob) -> int:
+    return await db.scalar(
+        select(func.count(SummaryJob.id)).where(
+            SummaryJob.status == JOB_PENDING,
+            SummaryJob.id != job.id,
+            (SummaryJob.priority > job.priority)
+            | ((SummaryJob.priority == job.priority) & (SummaryJob.id < job.id)),
+        )
+    )
+
+
+async def get_queue_stats(db: AsyncSession) -> dict[str, int]:
+    rows = await db.execute(
+        select(SummaryJob.status, func.count(SummaryJob.id))
+        .where(SummaryJob.delivered_at.is_(None))
+        .group_by(SummaryJob.status)
+    )
+    return dict(rows.all())
+
+
+async def count_active_jobs(db: AsyncSession, kind: str) -> int:
+    return await db.scalar(
+        select(func.count(SummaryJob.id)).where(
+            SummaryJob.kind == kind,
+            SummaryJob.status.in_((JOB_PENDING, JOB_RUNNING)),
+        )
+    )
+
+
+async def claim_next_job(db: AsyncSession) -> SummaryJob | None:
+    now_utc = datetime.now(UTC)
+    running_chats = select(SummaryJob.chat_id).where(SummaryJob.status == JOB_RUNNING)
+    job_id = await db.scalar(
+        select(SummaryJob.id)
+        .where(
+            SummaryJob.status == JOB_PENDING,
+            SummaryJob.run_after <= now_utc,
+            SummaryJob.chat_id.not_in(running_chats),
+        )
+        .order_by(SummaryJob.priority.desc(), SummaryJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    if job_id is None:
+        await db.commit()
+        return None
+
+    # Guarded on status so that backends without row locks (SQLite) still
+    # hand a job to exactly one worker.
+    claimed = await db.execute(
+        update(SummaryJob)
+        .where(SummaryJob.id == job_id, SummaryJob.status == JOB_PENDING)
+        .values(
+            status=JOB_RUNNING,
+            attempts=SummaryJob.attempts + 1,
+            started_at=now_utc,
+        )
+    )
+    await db.commit()
+    if claimed.rowcount != 1:
+        return None
+
+    job = await db.get(SummaryJob, job_id, populate_existing=True)
+
+    earlier_running = await db.scalar(
+        select(SummaryJob.id).where(
+            SummaryJob.chat_id == job.chat_id,
+            SummaryJob.status == JOB_RUNNING,
+            SummaryJob.id < job.id,
+        )
+    )
+    if earlier_running:
+        job.status = JOB_PENDING
+        job.attempts -= 1
+        await db.commit()
+        return None
+
+    return job
+
+
+async def complete_job(db: AsyncSession, job: SummaryJob, response: SummaryResponse):
+    job.status = JOB_COMPLETED
+    job.result = response.summary
+    job.cost = response.cost
+    job.model = response.model
+    job.finished_at = datetime.now(UTC)
+    await db.commit()
+    metrics.jobs_finished.inc(kind=job.kind, status=JOB_COMPLETED)
+    await resolve_followers(db, job.id)
+
+
+async def fail_job(db: AsyncSession, job: SummaryJob, error_message: str):
+    job.status = JOB_FAILED
+    job.last_error = error_message
+    job.finished_at = datetime.now(UTC)
+    await db.commit()
+    metrics.jobs_finished.inc(kind=job.kind, status=JOB_FAILED)
+    await resolve_followers(db, job.id)
+
+
+async def retry_job(db: AsyncSession, job: SummaryJob, error_message: str) -> bool:
+    if job.attempts >= settings.job_max_attempts:
+        return False
+
+    backoff = settings.job_retry_backoff_seconds * 2 ** (job.attempts - 1)
+    remaining = time_left(job)
+    if remaining is not None and remaining < backoff:
+        return False
+    job.status = JOB_PENDING
+    job.last_error = error_message
+    job.run_after = datetime.now(UTC) + timedelta(seconds=backoff)
+    await db.commit()
+    return True
+
+
+async def cancel_user_jobs(
+    db: AsyncSession, chat_id: int, user_id: str
+) -> list[SummaryJob]:
+    # The command that cancels a job answers the user itself, so cancelled
+    # jobs are marked delivered right away.
+    jobs = (
+        await db.scalars(
+            select(SummaryJob).where(
+                SummaryJob.chat_id == chat_id,
+                SummaryJob.user_id == user_id,
+                SummaryJob.kind != KIND_DIGEST,
+                SummaryJob.status.in_((JOB_PENDING, JOB_RUNNING, JOB_WAITING)),
+            )
+        )
+    ).all()
+    now_utc = datetime.now(UTC)
+    for job in jobs:
+        job.status = JOB_CANCELLED
+        job.finished_at = now_utc
+        job.delivered_at = now_utc
+        metrics.jobs_finished.inc(kind=job.kind, status=JOB_CANCELLED)
+    await db.commit()
+    for job in jobs:
+        if job.coalesced_into is None:
+            await resolve_followers(db, job.id)
+    return jobs
+
+
+async def get_cancelled_job_ids(db: AsyncSession, job_ids: list[int]) -> set[int]:
+    if not job_ids:
+        return set()
+    ids = await db.scalars(
+        select(SummaryJob.id).where(
+            SummaryJob.id.in_(job_ids), SummaryJob.status == JOB_CANCELLED
+        )
+    )
+    return set(ids)
+
+
+async def mark_delivered(db: AsyncSession, job: SummaryJob):
+    job.delivered_at = datetime.now(UTC)
+    await db.commit()
+
+
+async def get_undelivered_jobs(db: AsyncSession, limit: int = 20) -> list[SummaryJob]:
+    jobs = await db.scalars(
+        select(SummaryJob)
+        .where(
+            SummaryJob.status.in_((JOB_COMPLETED, JOB_FAILED)),
+            SummaryJob.delivered_at.is_(None),
+        )
+        .order_by(SummaryJob.id)
+        .limit(limit)
+    )
+    return jobs.all()
+
+
+async def requeue_stale_jobs(db: AsyncSession) -> int:
+    stale_before = datetime.now(UTC) - timedelta(
+        seconds=settings.job_stale_after_seconds
+    )
+    result = await db.execute(
+        update(SummaryJob)
+        .where(SummaryJob.status == JOB_RUNNING, SummaryJob.started_at < stale_before)
+        .values(status=JOB_PENDING)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def release_jobs(db: AsyncSession, job_ids: list[int]) -> int:
+    # Interrupted jobs go straight back to the queue instead of waiting for
+    # requeue_stale_jobs; the attempt they used is given back.
+    if not job_ids:
+        return 0
+    result = await db.execute(
+        update(SummaryJob)
+        .where(SummaryJob.id.in_(job_ids), SummaryJob.status == JOB_RUNNING)
+        .values(status=JOB_PENDING, attempts=SummaryJob.attempts - 1)
+    )
+    await db.commit()
+    return result.rowcount
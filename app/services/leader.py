@@ -0,0 +1,98 @@
+import asyncio
+import fcntl
+import logging
+import zlib
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.database import database_url, get_engine
+from app.loader import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    # Only the holder of this lock may start the Telegram client: two
+    # processes on one session file would fight over updates and the session.
+    # Postgres uses a session-level advisory lock kept on a dedicated
+    # connection; other databases fall back to a file lock next to the session.
+
+    def __init__(self, name: str):
+        self.name = name
+        self.key = zlib.crc32(name.encode())
+        self._connection: AsyncConnection | None = None
+        self._lock_file = None
+
+    @property
+    def uses_advisory_lock(self) -> bool:
+        return database_url.startswith("postgresql")
+
+    async def acquire(self):
+        while not await self.try_acquire():
+            logger.info(
+                f"Сессия '{self.name}' занята другим процессом, повтор через "
+                f"{settings.leader_lock_retry_seconds} с"
+            )
+            await asyncio.sleep(settings.leader_lock_retry_seconds)
+        logger.info(f"Получена блокировка сессии '{self.name}'")
+
+    async def try_acquire(self) -> bool:
+        if not self.uses_advisory_lock:
+            return self._try_lock_file()
+
+        connection = await get_engine().connect()
+        try:
+            # Autocommit keeps the long-lived connection out of an open
+            # transaction while it holds the lock.
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+            acquired = await connection.scalar(
+                text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}
+            )
+        except BaseException:
+            await connection.close()
+            raise
+        if not acquired:
+            await connection.close()
+            return False
+        self._connection = connection
+        return True
+
+    def _try_lock_file(self) -> bool:
+        lock_file = open(f"{self.name}.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def wait_lost(self):
+        # Returns once the connection holding the advisory lock is gone, since
+        # Postgres releases the lock together with it.
+        while True:
+            await asyncio.sleep(settings.leader_lock_retry_seconds)
+            if self._connection is None:
+                continue
+            try:
+                await self._connection.execute(text("SELECT 1"))
+            except Exception:
+                logger.exception(f"Потеряна блокировка сессии '{self.name}'")
+                return
+
+    async def release(self):
+        if self._connection is not None:
+            try:
+                await self._connection.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": self.key}
+                )
+            except Exception:
+                logger.exception(f"Не удалось снять блокировку сессии '{self.name}'")
+            finally:
+                await self._connection.close()
+                self._connection = None
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
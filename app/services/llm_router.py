@@ -0,0 +1,178 @@
+import logging
+import time
+from typing import Awaitable, Callable
+
+from app.config import LLMModel
+from app.loader import settings
+from app.services import metrics
+from app.services.openai import (
+    RateLimitError,
+    SummaryResponse,
+    get_default_model,
+    get_summary_from_openai,
+    stream_summary_from_openai,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+    def __init__(self, model: LLMModel):
+        self.model = model
+        self.latency_ewma = 0.0
+        self.error_ewma = 0.0
+        self.cooldown_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.model.name
+
+    @property
+    def context_tokens(self) -> int:
+        return self.model.context_tokens or settings.map_reduce_chunk_tokens
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def fits(self, prompt_tokens: int) -> bool:
+        return (
+            prompt_tokens + settings.llm_completion_reserve_tokens
+            <= self.context_tokens
+        )
+
+    def estimate_cost(self, prompt_tokens: int) -> float:
+        return (prompt_tokens / 1000) * self.model.price_per_1k_prompt
+
+    def _update(self, latency: float | None, failed: bool):
+        alpha = settings.llm_ewma_alpha
+        if latency is not None:
+            self.latency_ewma = (
+                latency
+                if not self.latency_ewma
+                else alpha * latency + (1 - alpha) * self.latency_ewma
+            )
+        self.error_ewma = alpha * float(failed) + (1 - alpha) * self.error_ewma
+        metrics.llm_latency_ewma.set(self.latency_ewma, model=self.name)
+        metrics.llm_error_rate_ewma.set(self.error_ewma, model=self.name)
+
+    def _cool_down(self, reason: str):
+        self.cooldown_until = time.monotonic() + settings.llm_cooldown_seconds
+        logger.warning(
+            f"Модель {self.name} временно исключена из маршрутизации: {reason}"
+        )
+
+    def record_success(self, latency: float):
+        self._update(latency, failed=False)
+        if self.latency_ewma > settings.llm_slow_latency_seconds:
+            self._cool_down(f"средняя задержка {self.latency_ewma:.1f} с")
+
+    def record_failure(self, error: Exception):
+        self._update(None, failed=True)
+        if isinstance(error, RateLimitError):
+            self._cool_down("превышен лимит запросов")
+        elif self.error_ewma > settings.llm_max_error_rate:
+            self._cool_down(f"доля ошибок {self.error_ewma:.2f}")
+
+
+class LLMRouter:
+    def __init__(self, models: list[LLMModel]):
+        self.backends = {model.name: Backend(model) for model in models}
+
+    def routing_key(self, preferred_models: tuple[str, ...] = ()) -> str:
+        # Identifies what a request may be routed to, for summary cache keys:
+        # changing the prompt's preferred models or the configured backends
+        # starts a new cache. Health and latency are not part of it, so a
+        # cached answer may come from another backend of the same setup.
+        backends = ";".join(
+            backend.model.model_dump_json(exclude={"api_key", "max_concurrency"})
+            for backend in self.backends.values()
+        )
+        return ",".join(preferred_models) + "|" + backends
+
+    def fits(self, prompt_tokens: int) -> bool:
+        return any(backend.fits(prompt_tokens) for backend in self.backends.values())
+
+    def candidates(
+        self, prompt_tokens: int, preferred_models: tuple[str, ...] = ()
+    ) -> list[Backend]:
+        # Backends whose context fits the request, healthy ones first, then
+        # the prompt's preferred models in their order, then the cheapest and
+        # fastest. Small transcripts thus land on cheap short-context models
+        # and large ones on whichever long-context model can take them. When
+        # nothing fits, the largest model is tried anyway.
+        eligible = [
+            backend for backend in self.backends.values() if backend.fits(prompt_tokens)
+        ] or [max(self.backends.values(), key=lambda backend: backend.context_tokens)]
+
+        def sort_key(backend: Backend):
+            preference = (
+                preferred_models.index(backend.name)
+                if backend.name in preferred_models
+                else len(preferred_models)
+            )
+            return (
+                not backend.healthy,
+                preference,
+                backend.estimate_cost(prompt_tokens),
+                backend.latency_ewma,
+            )
+
+        return sorted(eligible, key=sort_key)
+
+    def estimate_cost(
+        self, prompt_tokens: int, preferred_models: tuple[str, ...] = ()
+    ) -> float:
+        return self.candidates(prompt_tokens, preferred_models)[0].estimate_cost(
+            prompt_tokens
+        )
+
+    async def summarize(
+        self,
+        text: str,
+        system_prompt: str,
+        prompt_tokens: int,
+        preferred_models: tuple[str, ...] = (),
+        on_delta: Callable[[str], Awaitable[None]] | None = None,
+    ) -> SummaryResponse:
+        candidates = self.candidates(prompt_tokens, preferred_models)
+        streamed = False
+
+        async def track_delta(delta: str):
+            nonlocal streamed
+            streamed = True
+            await on_delta(delta)
+
+        last_error = None
+        for backend in candidates:
+            started = time.perf_counter()
+            try:
+                if on_delta is not None:
+                    response = await stream_summary_from_openai(
+                        text, system_prompt, track_delta, backend.model
+                    )
+                else:
+                    response = await get_summary_from_openai(
+                        text, system_prompt, backend.model
+                    )
+            except (ConnectionError, TimeoutError) as e:
+                backend.record_failure(e)
+                # A partly streamed answer is already visible in the chat, so
+                # it cannot be silently replaced by another model's answer.
+                if streamed:
+                    raise
+                logger.warning(f"Модель {backend.name} не ответила: {e}")
+                last_error = e
+                continue
+
+            backend.record_success(time.perf_counter() - started)
+            return response
+
+        raise last_error
+
+
+def create_llm_router() -> LLMRouter:
+    return LLMRouter(settings.llm_models or [get_default_model()])
+
+
+llm_router = create_llm_router()
@@ -1,9 +1,27 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models import LogEntry
+from app.services.usage import record_usage
 
 
-def log_summary_request(db: Session, user_id: str, root_post_id: str):
-    log_entry = LogEntry(user_id=user_id, root_post_id=root_post_id)
+async def log_summary_request(
+    db: AsyncSession,
+    user_id: str,
+    chat_id: int,
+    prompt_name: str,
+    cached: bool = False,
+    cost: float = 0.0,
+    latency_seconds: float = 0.0,
+):
+    log_entry = LogEntry(user_id=user_id, root_post_id=str(chat_id))
     db.add(log_entry)
-    db.commit()
+    await db.commit()
+    await record_usage(
+        db,
+        chat_id,
+        user_id,
+        prompt_name,
+        cached=cached,
+        cost=cost,
+        latency_seconds=latency_seconds,
+    )
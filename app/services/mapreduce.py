@@ -0,0 +1,186 @@
+import asyncio
+import logging
+
+from app.loader import settings
+from app.services.llm_router import llm_router
+from app.services.openai import SummaryResponse
+from app.services.transcript import Transcript, count_tokens
+
+logger = logging.getLogger(__name__)
+
+MAP_INSTRUCTION = (
+    "\n\nТебе передана часть {index} из {total} длинной переписки. "
+    "Составь промежуточную сводку только по этой части, сохранив ключевые факты, "
+    "решения, участников и договорённости. Она будет объединена с остальными частями."
+)
+REDUCE_INSTRUCTION = (
+    "\n\nТебе переданы промежуточные сводки последовательных частей одной переписки. "
+    "Объедини их в одну итоговую сводку по правилам выше, убрав повторы."
+)
+
+
+class SummarizationError(Exception):
+    pass
+
+
+def _group_lines(
+    lines: list[str], line_tokens: list[int], max_tokens: int
+) -> list[tuple[str, int]]:
+    groups = []
+    current_lines = []
+    current_tokens = 0
+
+    for line, tokens in zip(lines, line_tokens):
+        if current_lines and current_tokens + tokens > max_tokens:
+            groups.append(("".join(current_lines), current_tokens))
+            current_lines = []
+            current_tokens = 0
+        current_lines.append(line)
+        current_tokens += tokens
+
+    if current_lines:
+        groups.append(("".join(current_lines), current_tokens))
+    return groups
+
+
+def split_into_chunks(
+    lines: list[str], line_tokens: list[int], max_tokens: int
+) -> list[str]:
+    return [chunk for chunk, _ in _group_lines(lines, line_tokens, max_tokens)]
+
+
+def estimate_map_reduce_cost(
+    transcript: Transcript,
+    system_prompt_tokens: int,
+    preferred_models: tuple[str, ...] = (),
+) -> float:
+    # Each part goes to the cheapest model that fits it, and the final reduce
+    # gets at most one chunk of partial summaries.
+    groups = _group_lines(
+        transcript.lines,
+        transcript.line_tokens,
+        settings.map_reduce_chunk_tokens - transcript.header_tokens,
+    )
+    map_cost = sum(
+        llm_router.estimate_cost(
+            transcript.header_tokens + tokens + system_prompt_tokens,
+            preferred_models,
+        )
+        for _, tokens in groups
+    )
+    reduce_cost = llm_router.estimate_cost(
+        settings.map_reduce_chunk_tokens + system_prompt_tokens, preferred_models
+    )
+    return map_cost + reduce_cost
+
+
+async def _summarize(
+    text: str, system_prompt: str, preferred_models: tuple[str, ...]
+) -> SummaryResponse:
+    return await llm_router.summarize(
+        text,
+        system_prompt,
+        count_tokens(system_prompt + text),
+        preferred_models,
+    )
+
+
+async def _summarize_chunks(
+    chunks: list[str], system_prompt: str, preferred_models: tuple[str, ...]
+) -> list[SummaryResponse]:
+    semaphore = asyncio.Semaphore(settings.map_reduce_concurrency)
+
+    async def summarize_chunk(index: int, chunk: str) -> SummaryResponse:
+        async with semaphore:
+            return await _summarize(
+                chunk,
+                system_prompt
+                + MAP_INSTRUCTION.format(index=index + 1, total=len(chunks)),
+                preferred_models,
+            )
+
+    tasks = [
+        asyncio.ensure_future(summarize_chunk(index, chunk))
+        for index, chunk in enumerate(chunks)
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        # One failed part fails the request; the other calls would only hold
+        # semaphore slots and spend tokens that are never recorded.
+        for task in tasks:
+            task.cancel()
+
+
+def _combine(
+    summary: str, model: str | None, responses: list[SummaryResponse]
+) -> SummaryResponse:
+    return SummaryResponse(
+        summary=summary,
+        cost=sum(response.cost for response in responses),
+        model=model,
+        prompt_tokens=sum(response.prompt_tokens for response in responses),
+        completion_tokens=sum(response.completion_tokens for response in responses),
+    )
+
+
+async def summarize_map_reduce(
+    transcript: Transcript, system_prompt: str, preferred_models: tuple[str, ...] = ()
+) -> SummaryResponse:
+    responses = []
+    # Every part carries the transcript header so the speaker aliases resolve.
+    chunks = [
+        transcript.header + chunk
+        for chunk in split_into_chunks(
+            transcript.lines,
+            transcript.line_tokens,
+            settings.map_reduce_chunk_tokens - transcript.header_tokens,
+        )
+    ]
+
+    while True:
+        logger.info(f"Суммирование по частям: {len(chunks)} частей")
+        partials = await _summarize_chunks(chunks, system_prompt, preferred_models)
+        responses.extend(partials)
+
+        partial_lines = [
+            f"Часть {index}:\n{partial.summary}\n---\n"
+            for index, partial in enumerate(partials, start=1)
+        ]
+        partial_tokens = [count_tokens(line) for line in partial_lines]
+
+        if len(partials) == 1 or sum(partial_tokens) <= (
+            settings.map_reduce_chunk_tokens
+        ):
+            break
+
+        next_chunks = split_into_chunks(
+            partial_lines, partial_tokens, settings.map_reduce_chunk_tokens
+        )
+        if len(next_chunks) >= len(partials):
+            # Every partial is close to the chunk size, so packing them does
+            # not shrink the round; pairing halves it at the cost of larger
+            # requests, as long as some model can still take a pair.
+            next_chunks = [
+                "".join(partial_lines[index : index + 2])
+                for index in range(0, len(partial_lines), 2)
+            ]
+            largest_pair = max(
+                sum(partial_tokens[index : index + 2])
+                for index in range(0, len(partial_tokens), 2)
+            )
+            if not llm_router.fits(largest_pair + count_tokens(system_prompt)):
+                raise SummarizationError(
+                    "обработка отменена. Промежуточные сводки слишком длинные, "
+                    "чтобы объединить их в одну."
+                )
+        chunks = next_chunks
+
+    if len(partials) == 1:
+        return _combine(partials[0].summary, partials[0].model, responses)
+
+    final_response = await _summarize(
+        "".join(partial_lines), system_prompt + REDUCE_INSTRUCTION, preferred_models
+    )
+    responses.append(final_response)
+    return _combine(final_response.summary, final_response.model, responses)
@@ -0,0 +1,163 @@
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import ChatMessage, DigestSubscription, RollingSummary
+from app.services.history import fetch_history, fetch_history_page
+
+SAVE_BATCH_SIZE = 1000
+
+tracked_chats: set[int] = set()
+synced_chats: set[int] = set()
+
+
+async def load_tracked_chats(db: AsyncSession):
+    chat_ids = await db.scalars(select(ChatMessage.chat_id).distinct())
+    tracked_chats.update(chat_ids)
+
+
+def to_message_dict(record: ChatMessage) -> dict:
+    return {
+        "id": record.message_id,
+        "sender_id": record.sender_id,
+        "user": record.user,
+        "text": record.text,
+        "date": record.date.isoformat(),
+    }
+
+
+async def save_messages(db: AsyncSession, chat_id: int, messages: list[dict]):
+    if not messages:
+        return
+
+    rows = [
+        {
+            "chat_id": chat_id,
+            "message_id": msg["id"],
+            "sender_id": msg["sender_id"],
+            "user": msg["user"],
+            "text": msg["text"],
+            "date": datetime.fromisoformat(msg["date"]),
+        }
+        for msg in messages
+    ]
+    insert = sqlite_insert if db.bind.dialect.name == "sqlite" else pg_insert
+    for start in range(0, len(rows), SAVE_BATCH_SIZE):
+        await db.execute(
+            insert(ChatMessage)
+            .values(rows[start : start + SAVE_BATCH_SIZE])
+            .on_conflict_do_nothing(index_elements=["chat_id", "message_id"])
+        )
+    await db.commit()
+    tracked_chats.add(chat_id)
+
+
+async def update_message_text(
+    db: AsyncSession, chat_id: int, message_id: int, text: str
+):
+    await db.execute(
+        update(ChatMessage)
+        .where(ChatMessage.chat_id == chat_id, ChatMessage.message_id == message_id)
+        .values(text=text)
+    )
+    await db.commit()
+
+
+async def get_message_id_bounds(db: AsyncSession, chat_id: int):
+    result = await db.execute(
+        select(
+            func.min(ChatMessage.message_id),
+            func.max(ChatMessage.message_id),
+            func.count(ChatMessage.id),
+        ).where(ChatMessage.chat_id == chat_id)
+    )
+    return result.one()
+
+
+async def get_recent_messages(
+    db: AsyncSession,
+    chat_id: int,
+    limit: int,
+    max_message_id: int | None = None,
+    min_message_id: int | None = None,
+) -> list[dict]:
+    query = select(ChatMessage).where(ChatMessage.chat_id == chat_id)
+    if max_message_id is not None:
+        query = query.where(ChatMessage.message_id <= max_message_id)
+    if min_message_id is not None:
+        query = query.where(ChatMessage.message_id > min_message_id)
+
+    records = (
+        await db.scalars(query.order_by(ChatMessage.message_id.desc()).limit(limit))
+    ).all()
+    return [to_message_dict(record) for record in reversed(records)]
+
+
+async def prune_chat_messages(db: AsyncSession, chat_id: int, keep: int):
+    oldest_kept = await db.scalar(
+        select(ChatMessage.message_id)
+        .where(ChatMessage.chat_id == chat_id)
+        .order_by(ChatMessage.message_id.desc())
+        .offset(keep - 1)
+        .limit(1)
+    )
+    if oldest_kept is None:
+        return
+
+    await db.execute(
+        delete(ChatMessage).where(
+            ChatMessage.chat_id == chat_id, ChatMessage.message_id < oldest_kept
+        )
+    )
+    await db.commit()
+
+
+async def drop_stale_history(db: AsyncSession, chat_id: int, last_id: int):
+    # Rows up to last_id are cut off from the new ones by a hole that was not
+    # fetched. Rolling summaries and digest cursors stop at such a row, so
+    # they are reset as well instead of silently skipping the hole.
+    await db.execute(
+        delete(ChatMessage).where(
+            ChatMessage.chat_id == chat_id, ChatMessage.message_id <= last_id
+        )
+    )
+    await db.execute(delete(RollingSummary).where(RollingSummary.chat_id == chat_id))
+    await db.execute(
+        update(DigestSubscription)
+        .where(DigestSubscription.chat_id == chat_id)
+        .values(last_message_id=None)
+    )
+    await db.commit()
+
+
+async def sync_chat_history(
+    bot, db: AsyncSession, chat_id: int, limit: int
+) -> list[dict]:
+    first_id, last_id, stored_count = await get_message_id_bounds(db, chat_id)
+
+    if last_id is not None and chat_id not in synced_chats:
+        # Everything newer than the store is fetched, newest first, up to what
+        # the store may keep; one message more tells whether that was enough.
+        new_messages, overflow = await fetch_history_page(
+            bot, chat_id, settings.message_store_max_per_chat + 1, min_id=last_id
+        )
+        if overflow:
+            await drop_stale_history(db, chat_id, last_id)
+        await save_messages(db, chat_id, new_messages)
+        first_id, last_id, stored_count = await get_message_id_bounds(db, chat_id)
+
+    if last_id is None:
+        await save_messages(db, chat_id, await fetch_history(bot, chat_id, limit))
+    elif stored_count < limit:
+        older_messages = await fetch_history(
+            bot, chat_id, limit - stored_count, offset_id=first_id
+        )
+        await save_messages(db, chat_id, older_messages)
+
+    synced_chats.add(chat_id)
+    await prune_chat_messages(db, chat_id, settings.message_store_max_per_chat)
+    return await get_recent_messages(db, chat_id, limit)
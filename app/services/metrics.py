@@ -0,0 +1,225 @@
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal in-process metrics rendered in the Prometheus text format. Every
+# process has its own registry: the web app serves it at /metrics and the bot
+# process on BOT_METRICS_PORT. With EMBEDDED_BOT the bot thread shares the web
+# app's registry, so updates take a lock.
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple, **extra) -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"'
+        for name, value in list(zip(labelnames, values)) + list(extra.items())
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key: tuple, value) -> list[str]:
+        labels = _format_labels(self.labelnames, key)
+        return [f"{self.name}{labels} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_sample(self, key: tuple, value) -> list[str]:
+        counts, total = value
+        lines = [
+            f"{self.name}_bucket"
+            f"{_format_labels(self.labelnames, key, le=_format_value(bound))} {count}"
+            for bound, count in zip(self.buckets, counts)
+        ]
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+async def _serve_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Every request gets the registry; the request itself is not inspected.
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = registry.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body) + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.Server:
+    return await asyncio.start_server(_serve_scrape, host, port)
+
+
+stage_seconds = Histogram(
+    "summarizer_stage_seconds",
+    "Time spent in each stage of a summarization request.",
+    ["stage"],
+)
+cache_requests = Counter(
+    "summarizer_cache_requests_total",
+    "Cache lookups by cache and result.",
+    ["cache", "result"],
+)
+rate_limit_rejections = Counter(
+    "summarizer_rate_limit_rejections_total",
+    "Requests rejected by rate limits.",
+    ["scope"],
+)
+openai_errors = Counter(
+    "summarizer_openai_errors_total",
+    "Failed LLM API calls by error type and model.",
+    ["type", "model"],
+)
+openai_tokens = Counter(
+    "summarizer_openai_tokens_total",
+    "Tokens billed by LLM backends.",
+    ["kind", "model"],
+)
+openai_cost = Counter(
+    "summarizer_openai_cost_dollars_total",
+    "Estimated LLM spend in dollars.",
+    ["model"],
+)
+llm_latency_ewma = Gauge(
+    "summarizer_llm_latency_ewma_seconds",
+    "Moving average of LLM call latency by model.",
+    ["model"],
+)
+llm_error_rate_ewma = Gauge(
+    "summarizer_llm_error_rate_ewma",
+    "Moving average of the LLM call error rate by model.",
+    ["model"],
+)
+jobs_finished = Counter(
+    "summarizer_jobs_finished_total",
+    "Summarization jobs finished by kind and status.",
+    ["kind", "status"],
+)
+deadline_exceeded = Counter(
+    "summarizer_deadline_exceeded_total",
+    "Summarization requests that ran out of time by stage.",
+    ["stage"],
+)
+outbound_flood_waits = Counter(
+    "summarizer_outbound_flood_waits_total",
+    "FloodWait errors returned by Telegram for outgoing messages.",
+)
+telegram_flood_waits = Counter(
+    "summarizer_telegram_flood_waits_total",
+    "FloodWait errors returned by Telegram by session.",
+    ["session"],
+)
+queue_depth = Gauge(
+    "summarizer_queue_jobs",
+    "Undelivered summarization jobs by status.",
+    ["status"],
+)
@@ -1,42 +1,195 @@
+import asyncio
+import logging
 from collections import namedtuple
+from typing import Awaitable, Callable
 
+import httpx
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
 
+from app.config import LLMModel
 from app.loader import settings
+from app.services import metrics
 
-SummaryResponse = namedtuple("SummaryResponse", ["summary", "cost"])
+logger = logging.getLogger(__name__)
 
+SummaryResponse = namedtuple(
+    "SummaryResponse",
+    ["summary", "cost", "model", "prompt_tokens", "completion_tokens"],
+    defaults=(None, 0, 0),
+)
 
-def get_summary_from_openai(text: str, system_prompt: str) -> SummaryResponse:
-    client = OpenAI(
-        api_key=settings.openai_api_key,
+# Clients are shared by backends with the same endpoint and key; concurrency
+# is limited per backend.
+_clients: dict[tuple[str, str], AsyncOpenAI] = {}
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+class RateLimitError(ConnectionError):
+    pass
+
+
+def get_default_model() -> LLMModel:
+    return LLMModel(
+        name=settings.openai_model,
+        price_per_1k_prompt=settings.price_per_1k_prompt,
+        price_per_1k_completion=settings.price_per_1k_completion,
     )
-    try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text},
-            ],
-            model="gpt-4-turbo",
+
+
+def get_openai_client(model: LLMModel | None = None) -> AsyncOpenAI:
+    model = model or get_default_model()
+    base_url = model.base_url or settings.openai_base_url
+    api_key = model.api_key or settings.openai_api_key
+    client = _clients.get((base_url, api_key))
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url or None,
             timeout=settings.openai_timeout_seconds,
+            # With several backends the router fails over instead of retrying.
+            max_retries=(
+                0 if len(settings.llm_models) > 1 else openai.DEFAULT_MAX_RETRIES
+            ),
+            http_client=openai.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=settings.openai_max_connections,
+                    max_keepalive_connections=settings.openai_max_connections,
+                ),
+            ),
         )
+        _clients[(base_url, api_key)] = client
+    return client
 
-        prompt_tokens = chat_completion.usage.prompt_tokens
-        completion_tokens = chat_completion.usage.completion_tokens
-        summary_text = chat_completion.choices[0].message.content
 
-        cost = ((prompt_tokens / 1000) * settings.price_per_1k_prompt) + (
-            (completion_tokens / 1000) * settings.price_per_1k_completion
+def _get_semaphore(model: LLMModel) -> asyncio.Semaphore:
+    semaphore = _semaphores.get(model.name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(
+            model.max_concurrency or settings.openai_max_concurrency
         )
+        _semaphores[model.name] = semaphore
+    return semaphore
+
+
+async def close_openai_client():
+    for client in _clients.values():
+        await client.close()
+    _clients.clear()
+    _semaphores.clear()
+
+
+def calculate_cost(
+    prompt_tokens: int, completion_tokens: int, model: LLMModel | None = None
+) -> float:
+    model = model or get_default_model()
+    return ((prompt_tokens / 1000) * model.price_per_1k_prompt) + (
+        (completion_tokens / 1000) * model.price_per_1k_completion
+    )
+
+
+def _record_usage(
+    model: LLMModel, prompt_tokens: int, completion_tokens: int, cost: float
+):
+    metrics.openai_tokens.inc(prompt_tokens, kind="prompt", model=model.name)
+    metrics.openai_tokens.inc(completion_tokens, kind="completion", model=model.name)
+    metrics.openai_cost.inc(cost, model=model.name)
 
-        return SummaryResponse(summary=summary_text, cost=f"{cost:.4f}")
 
+def _convert_openai_error(e: openai.OpenAIError, model: LLMModel) -> Exception:
+    metrics.openai_errors.inc(type=type(e).__name__, model=model.name)
+    if isinstance(e, openai.APITimeoutError):
+        return TimeoutError(f"OpenAI API request timed out: {e}")
+    if isinstance(e, openai.APIConnectionError):
+        return ConnectionError(f"Failed to connect to OpenAI API: {e}")
+    if isinstance(e, openai.RateLimitError):
+        return RateLimitError(f"OpenAI API request exceeded rate limit: {e}")
+    return ConnectionError(f"OpenAI API returned an API Error: {e}")
+
+
+async def get_summary_from_openai(
+    text: str, system_prompt: str, model: LLMModel | None = None
+) -> SummaryResponse:
+    model = model or get_default_model()
+    client = get_openai_client(model)
+    try:
+        async with _get_semaphore(model):
+            with metrics.stage_seconds.time(stage="openai"):
+                chat_completion = await client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": text},
+                    ],
+                    model=model.model or model.name,
+                    timeout=settings.openai_timeout_seconds,
+                )
+    except openai.APIError as e:
+        raise _convert_openai_error(e, model)
+
+    prompt_tokens = chat_completion.usage.prompt_tokens
+    completion_tokens = chat_completion.usage.completion_tokens
+    summary_text = chat_completion.choices[0].message.content
+
+    cost = calculate_cost(prompt_tokens, completion_tokens, model)
+    _record_usage(model, prompt_tokens, completion_tokens, cost)
+    return SummaryResponse(
+        summary=summary_text,
+        cost=cost,
+        model=model.name,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+    )
+
+
+async def stream_summary_from_openai(
+    text: str,
+    system_prompt: str,
+    on_delta: Callable[[str], Awaitable[None]],
+    model: LLMModel | None = None,
+) -> SummaryResponse:
+    model = model or get_default_model()
+    client = get_openai_client(model)
+    summary_parts = []
+    usage = None
+    try:
+        async with _get_semaphore(model):
+            with metrics.stage_seconds.time(stage="openai"):
+                stream = await client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": text},
+                    ],
+                    model=model.model or model.name,
+                    timeout=settings.openai_timeout_seconds,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        summary_parts.append(delta)
+                        await on_delta(delta)
     except openai.APIError as e:
-        raise ConnectionError(f"OpenAI API returned an API Error: {e}")
-    except openai.APIConnectionError as e:
-        raise ConnectionError(f"Failed to connect to OpenAI API: {e}")
-    except openai.RateLimitError as e:
-        raise ConnectionError(f"OpenAI API request exceeded rate limit: {e}")
-    except openai.Timeout as e:
-        raise TimeoutError(f"OpenAI API request timed out: {e}")
+        raise _convert_openai_error(e, model)
+
+    prompt_tokens = completion_tokens = 0
+    if usage is None:
+        logger.warning("OpenAI не вернул usage для потокового ответа")
+        cost = 0.0
+    else:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        cost = calculate_cost(prompt_tokens, completion_tokens, model)
+        _record_usage(model, prompt_tokens, completion_tokens, cost)
+
+    return SummaryResponse(
+        summary="".join(summary_parts),
+        cost=cost,
+        model=model.name,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+    )
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+
+from telethon.errors import FloodWaitError
+
+from app.constants import TELEGRAM_MESSAGE_LIMIT
+from app.loader import settings
+from app.services import metrics
+from app.services.cache import TTLCache
+from app.services.client_pool import configured_sessions
+
+logger = logging.getLogger(__name__)
+
+CODE_FENCE = "```"
+SPLIT_SEPARATORS = ("\n\n", "\n", " ")
+# Rates recover by this factor after every successful call and drop by
+# FLOOD_BACKOFF_FACTOR after a FloodWait, never below MIN_RATE_FRACTION.
+RATE_RECOVERY_FACTOR = 1.05
+FLOOD_BACKOFF_FACTOR = 0.5
+MIN_RATE_FRACTION = 0.1
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    # Walks the text once, cutting at a paragraph, line or word break inside
+    # each window. A cut inside a ``` block closes it and reopens it in the
+    # next part so every part renders as valid markdown on its own.
+    parts = []
+    start = 0
+    in_code = False
+    while start < len(text):
+        prefix = CODE_FENCE + "\n" if in_code else ""
+        budget = limit - len(prefix) - len(CODE_FENCE) - 1
+        if len(text) - start <= limit - len(prefix):
+            parts.append(prefix + text[start:])
+            break
+
+        end = start + budget
+        cut, skip = end, 0
+        for separator in SPLIT_SEPARATORS:
+            position = text.rfind(separator, start, end)
+            if position > start:
+                cut, skip = position, len(separator)
+                break
+
+        fences = text.count(CODE_FENCE, start, cut)
+        opened = in_code != (fences % 2 == 1)
+        part = prefix + text[start:cut]
+        if opened:
+            part += "\n" + CODE_FENCE
+        parts.append(part)
+
+        in_code = opened
+        start = cut + skip
+    return parts
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        # Takes a token immediately and returns how long the caller must wait
+        # for it, so concurrent senders queue up without a lock.
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float):
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def slow_down(self):
+        self.rate = max(
+            self.base_rate * MIN_RATE_FRACTION, self.rate * FLOOD_BACKOFF_FACTOR
+        )
+
+    def recover(self):
+        self.rate = min(self.base_rate, self.rate * RATE_RECOVERY_FACTOR)
+
+
+class OutboundSender:
+    def __init__(self):
+        # The global limit is per account, so every session adds its share.
+        global_rate = settings.outbound_global_rate_per_second * len(
+            configured_sessions()
+        )
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = TTLCache(
+            ttl_seconds=settings.entity_cache_ttl_seconds,
+            max_size=settings.entity_cache_max_size,
+        )
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(
+                settings.outbound_chat_rate_per_minute / 60,
+                settings.outbound_chat_burst,
+            )
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _wait_turn(self, chat_bucket: TokenBucket):
+        await asyncio.sleep(chat_bucket.reserve())
+        await asyncio.sleep(self.global_bucket.reserve())
+
+    async def _call(self, chat_id, method, *args, **kwargs):
+        chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_bucket)
+            try:
+                result = await method(*args, **kwargs)
+            except FloodWaitError as e:
+                metrics.outbound_flood_waits.inc()
+                chat_bucket.pause(e.seconds)
+                chat_bucket.slow_down()
+                self.global_bucket.slow_down()
+
+                attempt += 1
+                if (
+                    attempt > settings.outbound_max_retries
+                    or e.seconds > settings.outbound_max_flood_wait_seconds
+                ):
+                    raise
+                logger.warning(
+                    f"FloodWait {e.seconds}s при отправке в чат {chat_id}, "
+                    f"повтор {attempt}/{settings.outbound_max_retries}"
+                )
+                continue
+
+            chat_bucket.recover()
+            self.global_bucket.recover()
+            return result
+
+    async def send_message(self, bot, chat_id, text, **kwargs):
+        return await self._call(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+    async def edit_message(self, bot, chat_id, message, text, **kwargs):
+        return await self._call(
+            chat_id, bot.edit_message, chat_id, message, text, **kwargs
+        )
+
+    async def send_long_message(self, bot, chat_id, text, reply_to=None):
+        # Parts are retried one by one, so a FloodWait midway never resends
+        # the parts that already went out.
+        with metrics.stage_seconds.time(stage="send"):
+            for part in split_message(text):
+                await self.send_message(
+                    bot, chat_id, part, reply_to=reply_to, parse_mode="md"
+                )
+
+
+outbound = OutboundSender()
@@ -1,40 +1,152 @@
-from sqlalchemy.orm import Session
+import logging
+import time
+from collections import namedtuple
 
-from app.models import Prompt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.loader import settings
+from app.models import Prompt, PromptVersion
+from app.services.transcript import count_tokens
 
-def get_all_prompts(db: Session):
-    return db.query(Prompt).all()
+logger = logging.getLogger(__name__)
 
+CachedPrompt = namedtuple(
+    "CachedPrompt", ["id", "name", "text", "token_count", "preferred_models"]
+)
 
-def create_prompt(db: Session, name: str, text: str):
-    db_prompt = Prompt(name=name, text=text)
+
+def parse_model_names(value: str | None) -> tuple[str, ...]:
+    return tuple(name.strip() for name in (value or "").split(",") if name.strip())
+
+
+async def get_all_prompts(db: AsyncSession):
+    return (await db.scalars(select(Prompt))).all()
+
+
+async def get_prompts_version(db: AsyncSession) -> int:
+    version = await db.scalar(
+        select(PromptVersion.version).where(PromptVersion.id == 1)
+    )
+    return version or 0
+
+
+async def _bump_prompts_version(db: AsyncSession):
+    record = await db.get(PromptVersion, 1)
+    if record:
+        record.version += 1
+    else:
+        db.add(PromptVersion(id=1, version=1))
+
+
+async def create_prompt(
+    db: AsyncSession, name: str, text: str, preferred_models: str = ""
+):
+    db_prompt = Prompt(
+        name=name,
+        text=text,
+        preferred_models=",".join(parse_model_names(preferred_models)) or None,
+    )
     db.add(db_prompt)
-    db.commit()
-    db.refresh(db_prompt)
+    await _bump_prompts_version(db)
+    await db.commit()
+    await db.refresh(db_prompt)
+    prompt_registry.invalidate()
     return db_prompt
 
 
-def get_prompt_by_name(db: Session, name: str):
-    return db.query(Prompt).filter(Prompt.name == name).first()
+async def get_prompt_by_name(db: AsyncSession, name: str):
+    return await db.scalar(select(Prompt).where(Prompt.name == name))
 
 
-def get_prompt_by_id(db: Session, prompt_id: int):
-    return db.query(Prompt).filter(Prompt.id == prompt_id).first()
+async def get_prompt_by_id(db: AsyncSession, prompt_id: int):
+    return await db.get(Prompt, prompt_id)
 
 
-def update_prompt(db: Session, prompt_id: int, name: str, text: str):
-    db_prompt = db.query(Prompt).filter(Prompt.id == prompt_id).first()
+async def update_prompt(
+    db: AsyncSession,
+    prompt_id: int,
+    name: str,
+    text: str,
+    preferred_models: str = "",
+):
+    db_prompt = await db.get(Prompt, prompt_id)
     if db_prompt:
         db_prompt.name = name
         db_prompt.text = text
-        db.commit()
-        db.refresh(db_prompt)
+        db_prompt.preferred_models = (
+            ",".join(parse_model_names(preferred_models)) or None
+        )
+        await _bump_prompts_version(db)
+        await db.commit()
+        await db.refresh(db_prompt)
+        prompt_registry.invalidate()
     return db_prompt
 
 
-def delete_prompt(db: Session, prompt_id: int):
-    db_prompt = db.query(Prompt).filter(Prompt.id == prompt_id).first()
+async def delete_prompt(db: AsyncSession, prompt_id: int):
+    db_prompt = await db.get(Prompt, prompt_id)
     if db_prompt:
-        db.delete(db_prompt)
-        db.commit()
+        await db.delete(db_prompt)
+        await _bump_prompts_version(db)
+        await db.commit()
+        prompt_registry.invalidate()
+
+
+def count_prompt_tokens(text: str) -> int | None:
+    try:
+        return count_tokens(text)
+    except Exception as e:
+        logger.warning(f"Не удалось посчитать токены промпта: {e}")
+        return None
+
+
+class PromptRegistry:
+    def __init__(self):
+        self._prompts: dict[str, CachedPrompt] | None = None
+        self._version: int | None = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        self._prompts = None
+
+    async def _load(self, db: AsyncSession):
+        version = await get_prompts_version(db)
+        self._prompts = {
+            prompt.name: CachedPrompt(
+                id=prompt.id,
+                name=prompt.name,
+                text=prompt.text,
+                token_count=count_prompt_tokens(prompt.text),
+                preferred_models=parse_model_names(prompt.preferred_models),
+            )
+            for prompt in await get_all_prompts(db)
+        }
+        self._version = version
+        self._checked_at = time.monotonic()
+
+    async def _ensure_fresh(self, db: AsyncSession):
+        if self._prompts is None:
+            await self._load(db)
+            return
+
+        if (
+            time.monotonic() - self._checked_at
+            < settings.prompt_registry_check_interval_seconds
+        ):
+            return
+
+        self._checked_at = time.monotonic()
+        if await get_prompts_version(db) != self._version:
+            await self._load(db)
+
+    async def get(self, db: AsyncSession, name: str) -> CachedPrompt | None:
+        await self._ensure_fresh(db)
+        return self._prompts.get(name)
+
+    async def all(self, db: AsyncSession) -> list[CachedPrompt]:
+        await self._ensure_fresh(db)
+        return list(self._prompts.values())
+
+
+prompt_registry = PromptRegistry()
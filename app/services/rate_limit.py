@@ -0,0 +1,245 @@
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, UTC, timedelta
+
+from sqlalchemy import delete, func, make_url, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import SessionLocal, database_url
+from app.loader import settings
+from app.models import ChatSummary, LogEntry, RateLimitHit
+
+USER_WINDOW_SECONDS = 3600
+
+
+def _as_timestamp(value: datetime) -> float:
+    aware_value = value.replace(tzinfo=UTC) if value.tzinfo is None else value
+    return aware_value.timestamp()
+
+
+class RateLimitBackend(ABC):
+    async def load(self, db: AsyncSession):
+        pass
+
+    @abstractmethod
+    async def check_user(self, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def reserve_user(self, user_id: str) -> bool: ...
+
+    @abstractmethod
+    async def release_user(self, user_id: str): ...
+
+    @abstractmethod
+    async def check_chat(self, chat_key: str) -> bool: ...
+
+    @abstractmethod
+    async def reserve_chat(self, chat_key: str) -> bool: ...
+
+    @abstractmethod
+    async def release_chat(self, chat_key: str): ...
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    def __init__(self, user_limit: int, chat_cooldown_seconds: int):
+        self.user_limit = user_limit
+        self.chat_cooldown_seconds = chat_cooldown_seconds
+        self._user_hits: dict[str, deque[float]] = {}
+        self._chat_reserved_at: dict[str, float] = {}
+
+    async def load(self, db: AsyncSession):
+        user_since = datetime.now(UTC) - timedelta(seconds=USER_WINDOW_SECONDS)
+        user_hits = await db.execute(
+            select(LogEntry.user_id, LogEntry.called_at)
+            .where(LogEntry.called_at >= user_since)
+            .order_by(LogEntry.called_at)
+        )
+        for user_id, called_at in user_hits:
+            self._user_hits.setdefault(user_id, deque()).append(
+                _as_timestamp(called_at)
+            )
+
+        chat_since = datetime.now(UTC) - timedelta(seconds=self.chat_cooldown_seconds)
+        chat_reservations = await db.execute(
+            select(ChatSummary.root_post_id, ChatSummary.summarized_at).where(
+                ChatSummary.summarized_at >= chat_since
+            )
+        )
+        for root_post_id, summarized_at in chat_reservations:
+            self._chat_reserved_at[root_post_id] = _as_timestamp(summarized_at)
+
+    def _user_window(self, user_id: str, now: float) -> deque[float]:
+        hits = self._user_hits.get(user_id)
+        if hits is None:
+            return deque()
+
+        while hits and hits[0] <= now - USER_WINDOW_SECONDS:
+            hits.popleft()
+        if not hits:
+            del self._user_hits[user_id]
+        return hits
+
+    async def check_user(self, user_id: str) -> bool:
+        return len(self._user_window(user_id, time.time())) < self.user_limit
+
+    async def reserve_user(self, user_id: str) -> bool:
+        now = time.time()
+        if len(self._user_window(user_id, now)) >= self.user_limit:
+            return False
+        self._user_hits.setdefault(user_id, deque()).append(now)
+        return True
+
+    async def release_user(self, user_id: str):
+        hits = self._user_hits.get(user_id)
+        if hits:
+            hits.pop()
+
+    async def check_chat(self, chat_key: str) -> bool:
+        reserved_at = self._chat_reserved_at.get(chat_key)
+        if reserved_at is None:
+            return True
+        if time.time() - reserved_at >= self.chat_cooldown_seconds:
+            del self._chat_reserved_at[chat_key]
+            return True
+        return False
+
+    async def reserve_chat(self, chat_key: str) -> bool:
+        if not await self.check_chat(chat_key):
+            return False
+        self._chat_reserved_at[chat_key] = time.time()
+        return True
+
+    async def release_chat(self, chat_key: str):
+        self._chat_reserved_at.pop(chat_key, None)
+
+
+class DatabaseRateLimitBackend(RateLimitBackend):
+    # Reservations rely on advisory locks and INSERT ... ON CONFLICT with a
+    # WHERE clause, so the shared limits need PostgreSQL.
+
+    def __init__(self, user_limit: int, chat_cooldown_seconds: int):
+        if make_url(database_url).get_backend_name() != "postgresql":
+            raise ValueError(
+                "RATE_LIMIT_BACKEND=database требует PostgreSQL в DATABASE_URL; "
+                "для одного процесса бота используйте RATE_LIMIT_BACKEND=memory"
+            )
+        self.user_limit = user_limit
+        self.chat_cooldown_seconds = chat_cooldown_seconds
+
+    async def _count_user_hits(self, db: AsyncSession, user_id: str) -> int:
+        since = datetime.now(UTC) - timedelta(seconds=USER_WINDOW_SECONDS)
+        return await db.scalar(
+            select(func.count(RateLimitHit.id)).where(
+                RateLimitHit.key == user_id, RateLimitHit.hit_at >= since
+            )
+        )
+
+    async def check_user(self, user_id: str) -> bool:
+        async with SessionLocal() as db:
+            return await self._count_user_hits(db, user_id) < self.user_limit
+
+    async def reserve_user(self, user_id: str) -> bool:
+        async with SessionLocal() as db:
+            await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(user_id))))
+            if await self._count_user_hits(db, user_id) >= self.user_limit:
+                await db.rollback()
+                return False
+
+            db.add(RateLimitHit(key=user_id, hit_at=datetime.now(UTC)))
+            await db.execute(
+                delete(RateLimitHit).where(
+                    RateLimitHit.hit_at
+                    < datetime.now(UTC) - timedelta(seconds=USER_WINDOW_SECONDS)
+                )
+            )
+            await db.commit()
+            return True
+
+    async def release_user(self, user_id: str):
+        async with SessionLocal() as db:
+            latest_hit = await db.scalar(
+                select(RateLimitHit)
+                .where(RateLimitHit.key == user_id)
+                .order_by(RateLimitHit.hit_at.desc())
+                .limit(1)
+            )
+            if latest_hit:
+                await db.delete(latest_hit)
+                await db.commit()
+
+    async def check_chat(self, chat_key: str) -> bool:
+        since = datetime.now(UTC) - timedelta(seconds=self.chat_cooldown_seconds)
+        async with SessionLocal() as db:
+            return not await db.scalar(
+                select(ChatSummary.id).where(
+                    ChatSummary.root_post_id == chat_key,
+                    ChatSummary.summarized_at >= since,
+                )
+            )
+
+    async def reserve_chat(self, chat_key: str) -> bool:
+        now_utc = datetime.now(UTC)
+        expired_before = now_utc - timedelta(seconds=self.chat_cooldown_seconds)
+        statement = (
+            pg_insert(ChatSummary)
+            .values(root_post_id=chat_key, summarized_at=now_utc)
+            .on_conflict_do_update(
+                index_elements=[ChatSummary.root_post_id],
+                set_={"summarized_at": now_utc},
+                where=ChatSummary.summarized_at < expired_before,
+            )
+            .returning(ChatSummary.id)
+        )
+        async with SessionLocal() as db:
+            reserved = (await db.execute(statement)).first() is not None
+            await db.commit()
+            return reserved
+
+    async def release_chat(self, chat_key: str):
+        expired_at = datetime.now(UTC) - timedelta(
+            seconds=self.chat_cooldown_seconds + 1
+        )
+        async with SessionLocal() as db:
+            await db.execute(
+                update(ChatSummary)
+                .where(ChatSummary.root_post_id == chat_key)
+                .values(summarized_at=expired_at)
+            )
+            await db.commit()
+
+
+def create_rate_limiter() -> RateLimitBackend:
+    backends = {
+        "memory": MemoryRateLimitBackend,
+        "database": DatabaseRateLimitBackend,
+    }
+    backend_class = backends[settings.rate_limit_backend]
+    return backend_class(
+        user_limit=settings.user_request_limit_per_hour,
+        chat_cooldown_seconds=settings.thread_request_cooldown_hours * 3600,
+    )
+
+
+rate_limiter = create_rate_limiter()
+
+
+async def update_rate_limit(
+    db: AsyncSession, root_post_id: str, summarized_at: datetime | None = None
+):
+    summary_record = await db.scalar(
+        select(ChatSummary).where(ChatSummary.root_post_id == root_post_id)
+    )
+
+    summarized_at = summarized_at or datetime.now(UTC)
+
+    if summary_record:
+        summary_record.summarized_at = summarized_at
+    else:
+        summary_record = ChatSummary(
+            root_post_id=root_post_id, summarized_at=summarized_at
+        )
+        db.add(summary_record)
+
+    await db.commit()
@@ -0,0 +1,45 @@
+from datetime import datetime, UTC
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import RollingSummary, SummaryJob
+
+
+async def get_rolling_summary(
+    db: AsyncSession, chat_id: int, prompt_name: str
+) -> RollingSummary | None:
+    return await db.scalar(
+        select(RollingSummary).where(
+            RollingSummary.chat_id == chat_id,
+            RollingSummary.prompt_name == prompt_name,
+        )
+    )
+
+
+def select_new_messages(
+    messages: list[dict], rolling_summary: RollingSummary | None
+) -> list[dict]:
+    if rolling_summary is None:
+        return messages
+    return [msg for msg in messages if msg["id"] > rolling_summary.last_message_id]
+
+
+async def save_rolling_summary(db: AsyncSession, job: SummaryJob):
+    rolling_summary = await get_rolling_summary(db, job.chat_id, job.prompt_name)
+    if rolling_summary is None:
+        rolling_summary = RollingSummary(
+            chat_id=job.chat_id, prompt_name=job.prompt_name
+        )
+        db.add(rolling_summary)
+    elif rolling_summary.last_message_id >= job.last_message_id:
+        return
+
+    rolling_summary.summary = job.result
+    rolling_summary.last_message_id = job.last_message_id
+    rolling_summary.updated_at = datetime.now(UTC)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution: the first caller
+    # runs the function, the rest wait for its result (or exception).
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> tuple:
+        # Returns (result, shared); shared is True for callers that waited on
+        # another caller's execution.
+        while (future := self._calls.get(key)) is not None:
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # The caller running func was cancelled (e.g. its deadline
+                # passed); this caller takes over instead of failing with it.
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting, so the exception is marked as retrieved.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
@@ -0,0 +1,204 @@
+import time
+from datetime import datetime, UTC
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import SpendEntry, SummaryJob
+from app.services.openai import SummaryResponse
+
+GLOBAL_SCOPE = ("global",)
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value.astimezone(UTC)
+
+
+def _periods(moment: datetime) -> tuple[str, str]:
+    moment = _as_utc(moment)
+    return moment.strftime("%Y-%m-%d"), moment.strftime("%Y-%m")
+
+
+def _month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+class SpendTracker:
+    # Keeps today's and this month's spend per chat, per user and overall, so
+    # admission checks are dictionary lookups. Workers in other processes write
+    # to the ledger, so new entries are pulled in by id every
+    # spend_sync_interval_seconds; only the first sync reads the whole month.
+
+    def __init__(self):
+        # scope -> [day, day_cost, month, month_cost]
+        self._totals: dict[tuple, list] = {}
+        self._last_entry_id: int | None = None
+        # Entries recorded by this process past _last_entry_id, counted
+        # already and skipped by the next sync.
+        self._recorded_ids: set[int] = set()
+        self._synced_at = 0.0
+
+    def _add(self, scope: tuple, cost: float, created_at: datetime):
+        day, month = _periods(created_at)
+        totals = self._totals.setdefault(scope, [day, 0.0, month, 0.0])
+        if month > totals[2]:
+            totals[2:] = [month, 0.0]
+        if day > totals[0]:
+            totals[:2] = [day, 0.0]
+        if month == totals[2]:
+            totals[3] += cost
+        if day == totals[0]:
+            totals[1] += cost
+
+    def _add_entry(self, chat_id: int, user_id: str, cost: float, created_at):
+        self._add(("chat", chat_id), cost, created_at)
+        self._add(("user", user_id), cost, created_at)
+        self._add(GLOBAL_SCOPE, cost, created_at)
+
+    def record(self, entry: SpendEntry):
+        # Spend of this process counts at once, so a burst of requests cannot
+        # overrun a budget between syncs. Before the first sync the entry is
+        # left to it, as it reads the whole month anyway.
+        if self._last_entry_id is None or entry.id <= self._last_entry_id:
+            return
+        self._add_entry(entry.chat_id, entry.user_id, entry.cost, entry.created_at)
+        self._recorded_ids.add(entry.id)
+
+    def spent(self, scope: tuple) -> tuple[float, float]:
+        totals = self._totals.get(scope)
+        if totals is None:
+            return 0.0, 0.0
+        day, month = _periods(datetime.now(UTC))
+        return (
+            totals[1] if totals[0] == day else 0.0,
+            totals[3] if totals[2] == month else 0.0,
+        )
+
+    async def sync(self, db: AsyncSession, force: bool = False):
+        if (
+            not force
+            and self._last_entry_id is not None
+            and time.monotonic() - self._synced_at
+            < settings.spend_sync_interval_seconds
+        ):
+            return
+
+        query = select(
+            SpendEntry.id,
+            SpendEntry.chat_id,
+            SpendEntry.user_id,
+            SpendEntry.cost,
+            SpendEntry.created_at,
+        ).order_by(SpendEntry.id)
+        if self._last_entry_id is None:
+            self._last_entry_id = await db.scalar(select(func.max(SpendEntry.id))) or 0
+            query = query.where(
+                SpendEntry.created_at >= _month_start(datetime.now(UTC)),
+                SpendEntry.id <= self._last_entry_id,
+            )
+        else:
+            query = query.where(SpendEntry.id > self._last_entry_id)
+
+        for entry_id, chat_id, user_id, cost, created_at in await db.execute(query):
+            if entry_id in self._recorded_ids:
+                self._recorded_ids.discard(entry_id)
+            else:
+                self._add_entry(chat_id, user_id, cost, created_at)
+            self._last_entry_id = max(self._last_entry_id, entry_id)
+        self._synced_at = time.monotonic()
+
+    async def check(self, db: AsyncSession, chat_id: int, user_id: str) -> str | None:
+        await self.sync(db)
+        limits = (
+            (
+                GLOBAL_SCOPE,
+                "бота",
+                settings.global_daily_budget,
+                settings.global_monthly_budget,
+            ),
+            (
+                ("chat", chat_id),
+                "чата",
+                settings.chat_daily_budget,
+                settings.chat_monthly_budget,
+            ),
+            (
+                ("user", user_id),
+                "пользователя",
+                settings.user_daily_budget,
+                settings.user_monthly_budget,
+            ),
+        )
+        for scope, label, daily_limit, monthly_limit in limits:
+            daily, monthly = self.spent(scope)
+            if daily_limit and daily >= daily_limit:
+                return f"дневной бюджет {label} (${daily_limit:.2f}) исчерпан"
+            if monthly_limit and monthly >= monthly_limit:
+                return f"месячный бюджет {label} (${monthly_limit:.2f}) исчерпан"
+        return None
+
+
+spend_tracker = SpendTracker()
+
+
+async def record_spend(db: AsyncSession, job: SummaryJob, response: SummaryResponse):
+    entry = SpendEntry(
+        job_id=job.id,
+        chat_id=job.chat_id,
+        user_id=job.user_id,
+        prompt_name=job.prompt_name,
+        model=response.model,
+        prompt_tokens=response.prompt_tokens,
+        completion_tokens=response.completion_tokens,
+        cost=response.cost,
+        created_at=datetime.now(UTC),
+    )
+    db.add(entry)
+    await db.commit()
+    spend_tracker.record(entry)
+
+
+async def get_spend_report(db: AsyncSession) -> dict:
+    now_utc = datetime.now(UTC)
+    month_start = _month_start(now_utc)
+    day_start = now_utc.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def grouped(column):
+        return (
+            select(
+                column,
+                func.count(SpendEntry.id),
+                func.sum(SpendEntry.prompt_tokens + SpendEntry.completion_tokens),
+                func.sum(SpendEntry.cost),
+            )
+            .where(SpendEntry.created_at >= month_start)
+            .group_by(column)
+            .order_by(func.sum(SpendEntry.cost).desc())
+        )
+
+    today_by_chat = dict(
+        (
+            await db.execute(
+                select(SpendEntry.chat_id, func.sum(SpendEntry.cost))
+                .where(SpendEntry.created_at >= day_start)
+                .group_by(SpendEntry.chat_id)
+            )
+        ).all()
+    )
+    return {
+        "today": sum(today_by_chat.values()),
+        "month": await db.scalar(
+            select(func.coalesce(func.sum(SpendEntry.cost), 0.0)).where(
+                SpendEntry.created_at >= month_start
+            )
+        ),
+        "chats": [
+            (chat_id, requests, tokens, cost, today_by_chat.get(chat_id, 0.0))
+            for chat_id, requests, tokens, cost in await db.execute(
+                grouped(SpendEntry.chat_id)
+            )
+        ],
+        "prompts": (await db.execute(grouped(SpendEntry.prompt_name))).all(),
+        "models": (await db.execute(grouped(SpendEntry.model))).all(),
+    }
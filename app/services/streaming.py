@@ -0,0 +1,81 @@
+import logging
+import time
+
+from telethon.errors import MessageNotModifiedError
+
+from app.constants import TELEGRAM_MESSAGE_LIMIT
+from app.loader import settings
+from app.services.outbound import outbound
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingReply:
+    def __init__(self, bot, chat_id: int, reply_to_id: int, header: str = ""):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_id = reply_to_id
+        self.text = header
+        self.message = None
+        self.sent_text = ""
+        self.last_flush_at = 0.0
+        self.streamed = False
+
+    async def append(self, delta: str):
+        self.streamed = True
+        self.text += delta
+
+        while len(self.text) > TELEGRAM_MESSAGE_LIMIT:
+            await self._roll_over()
+
+        if (
+            time.monotonic() - self.last_flush_at
+            >= settings.stream_edit_interval_seconds
+        ):
+            await self.flush()
+
+    async def finish(self, suffix: str = ""):
+        self.text += suffix
+
+        while len(self.text) > TELEGRAM_MESSAGE_LIMIT:
+            await self._roll_over()
+
+        await self.flush()
+
+    async def flush(self):
+        if not self.text.strip() or self.text == self.sent_text:
+            return
+
+        if self.message is None:
+            self.message = await outbound.send_message(
+                self.bot,
+                self.chat_id,
+                self.text,
+                reply_to=self.reply_to_id,
+                parse_mode="md",
+            )
+        else:
+            try:
+                await outbound.edit_message(
+                    self.bot, self.chat_id, self.message, self.text, parse_mode="md"
+                )
+            except MessageNotModifiedError:
+                pass
+
+        self.sent_text = self.text
+        self.last_flush_at = time.monotonic()
+
+    async def _roll_over(self):
+        part = self.text[:TELEGRAM_MESSAGE_LIMIT]
+        last_newline = part.rfind("\n")
+        if last_newline != -1:
+            head, tail = part[:last_newline], self.text[last_newline + 1 :]
+        else:
+            head, tail = part, self.text[TELEGRAM_MESSAGE_LIMIT:]
+
+        self.text = head
+        await self.flush()
+
+        self.text = tail
+        self.message = None
+        self.sent_text = ""
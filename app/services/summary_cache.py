@@ -0,0 +1,79 @@
+import hashlib
+from datetime import datetime, UTC, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import SummaryCacheEntry
+from app.services import metrics
+from app.services.cache import TTLCache
+from app.services.openai import SummaryResponse
+
+memory_cache = TTLCache(
+    ttl_seconds=settings.summary_cache_ttl_hours * 3600,
+    max_size=settings.summary_cache_max_entries,
+)
+
+
+def make_cache_key(transcript: str, prompt_text: str, routing_key: str) -> str:
+    digest = hashlib.sha256()
+    for part in (routing_key, prompt_text, transcript):
+        digest.update(part.encode("utf8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _expires_before() -> datetime:
+    return datetime.now(UTC) - timedelta(hours=settings.summary_cache_ttl_hours)
+
+
+async def get_cached_summary(
+    db: AsyncSession, cache_key: str
+) -> SummaryResponse | None:
+    cached = memory_cache.get(cache_key)
+    if cached is not None:
+        metrics.cache_requests.inc(cache="summary", result="hit")
+        return cached
+
+    entry = await db.scalar(
+        select(SummaryCacheEntry).where(
+            SummaryCacheEntry.cache_key == cache_key,
+            SummaryCacheEntry.created_at >= _expires_before(),
+        )
+    )
+    if not entry:
+        metrics.cache_requests.inc(cache="summary", result="miss")
+        return None
+
+    metrics.cache_requests.inc(cache="summary", result="hit")
+    cached = SummaryResponse(summary=entry.summary, cost=entry.cost)
+    memory_cache.set(cache_key, cached)
+    return cached
+
+
+async def store_summary(
+    db: AsyncSession, cache_key: str, response: SummaryResponse, model: str
+):
+    memory_cache.set(cache_key, response)
+
+    await db.execute(
+        delete(SummaryCacheEntry).where(
+            (SummaryCacheEntry.cache_key == cache_key)
+            | (SummaryCacheEntry.created_at < _expires_before())
+        )
+    )
+    db.add(
+        SummaryCacheEntry(
+            cache_key=cache_key,
+            summary=response.summary,
+            cost=response.cost,
+            model=model,
+            created_at=datetime.now(UTC),
+        )
+    )
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
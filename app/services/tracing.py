@@ -0,0 +1,43 @@
+import logging
+import uuid
+from contextvars import ContextVar
+
+from app.loader import settings
+
+NO_TRACE = "-"
+
+trace_id_var: ContextVar[str] = ContextVar("trace_id", default=NO_TRACE)
+
+
+def new_trace_id() -> str | None:
+    if not settings.tracing_enabled:
+        return None
+    return uuid.uuid4().hex[:16]
+
+
+def set_trace_id(trace_id: str | None):
+    return trace_id_var.set(trace_id or NO_TRACE)
+
+
+def get_trace_id() -> str | None:
+    trace_id = trace_id_var.get()
+    return None if trace_id == NO_TRACE else trace_id
+
+
+def configure_logging():
+    log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    if settings.tracing_enabled:
+        log_format = (
+            "%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s"
+        )
+        # Every record gets a trace_id attribute for the format above.
+        default_factory = logging.getLogRecordFactory()
+
+        def record_factory(*args, **kwargs):
+            record = default_factory(*args, **kwargs)
+            record.trace_id = trace_id_var.get()
+            return record
+
+        logging.setLogRecordFactory(record_factory)
+
+    logging.basicConfig(level=logging.INFO, format=log_format)
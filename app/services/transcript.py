@@ -0,0 +1,142 @@
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+
+import tiktoken
+
+from app.loader import settings
+from app.services import metrics
+from app.services.cache import TTLCache
+from app.services.compaction import compact_messages
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+TOKEN_CACHE_TTL_SECONDS = 24 * 3600
+
+# Memoized token counts keyed by encoding and message (or line prefix):
+# key -> (hash of the counted text, token count)
+line_token_cache = TTLCache(
+    ttl_seconds=TOKEN_CACHE_TTL_SECONDS,
+    max_size=settings.token_cache_max_size,
+)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = settings.openai_model) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, model: str = settings.openai_model) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def format_message(msg: dict) -> str:
+    return (
+        f"({msg['date']}) Пользователь '{msg['user']}' написал:\n{msg['text']}\n---\n"
+    )
+
+
+@dataclass
+class Transcript:
+    lines: list[str]
+    line_tokens: list[int] | None = None
+    header: str = ""
+    header_tokens: int = 0
+    original_token_count: int | None = None
+
+    @property
+    def text(self) -> str:
+        return self.header + "".join(self.lines)
+
+    @property
+    def token_count(self) -> int | None:
+        if self.line_tokens is None:
+            return None
+        return self.header_tokens + sum(self.line_tokens)
+
+    @property
+    def tokens_saved(self) -> int:
+        if self.original_token_count is None or self.token_count is None:
+            return 0
+        return self.original_token_count - self.token_count
+
+
+def _count_memoized(encoding: tiktoken.Encoding, key: tuple, text: str) -> int:
+    text_hash = hash(text)
+    cached = line_token_cache.get(key)
+    # Edited messages produce a different text and are counted again.
+    if cached is not None and cached[0] == text_hash:
+        return cached[1]
+
+    tokens = len(encoding.encode(text))
+    line_token_cache.set(key, (text_hash, tokens))
+    return tokens
+
+
+def _build_compact_transcript(
+    chat_id: int, messages: list[dict], encoding: tiktoken.Encoding | None
+) -> Transcript:
+    header, entries = compact_messages(messages)
+    lines = [entry.line for entry in entries]
+    if encoding is None:
+        return Transcript(lines=lines, header=header)
+
+    # A merged line is counted as its prefix plus the memoized message bodies,
+    # so shifting the window only encodes the messages that are new.
+    line_tokens = [
+        _count_memoized(encoding, ("prefix", encoding.name, entry.prefix), entry.prefix)
+        + sum(
+            _count_memoized(
+                encoding, (encoding.name, chat_id, msg["id"], "text"), msg["text"]
+            )
+            for msg in entry.messages
+        )
+        + len(entry.messages)
+        for entry in entries
+    ]
+    return Transcript(
+        lines=lines,
+        line_tokens=line_tokens,
+        header=header,
+        header_tokens=len(encoding.encode(header)),
+    )
+
+
+def build_transcript(
+    chat_id: int, messages: list[dict], model: str = settings.openai_model
+) -> Transcript:
+    with metrics.stage_seconds.time(stage="tokenization"):
+        return _build_transcript(chat_id, messages, model)
+
+
+def _build_transcript(chat_id: int, messages: list[dict], model: str) -> Transcript:
+    lines = [format_message(msg) for msg in messages]
+    try:
+        encoding = get_encoding(model)
+    except Exception as e:
+        logger.exception(f"Ошибка при подсчете токенов: {e}")
+        encoding = None
+
+    line_tokens = None
+    if encoding is not None:
+        line_tokens = [
+            _count_memoized(encoding, (encoding.name, chat_id, msg["id"]), line)
+            for msg, line in zip(messages, lines)
+        ]
+
+    if not settings.transcript_compaction_enabled:
+        return Transcript(lines=lines, line_tokens=line_tokens)
+
+    transcript = _build_compact_transcript(chat_id, messages, encoding)
+    if line_tokens is not None:
+        transcript.original_token_count = sum(line_tokens)
+        logger.info(
+            f"Сжатие переписки чата {chat_id}: "
+            f"{transcript.original_token_count} -> {transcript.token_count} токенов "
+            f"(сэкономлено {transcript.tokens_saved})"
+        )
+    return transcript
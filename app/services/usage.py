@@ -0,0 +1,146 @@
+from datetime import datetime, UTC, timedelta
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.loader import settings
+from app.models import LogEntry, UsageRollup
+
+PERIOD_HOUR = "hour"
+PERIOD_DAY = "day"
+ROLLUP_KEY = ("period", "period_start", "chat_id", "user_id", "prompt_name")
+COUNTERS = ("requests", "cache_hits", "failures", "cost", "latency_seconds")
+PRUNE_BATCH_SIZE = 10000
+REPORT_TOP = 20
+
+
+def _period_starts(moment: datetime) -> dict[str, datetime]:
+    hour = moment.replace(minute=0, second=0, microsecond=0)
+    return {PERIOD_HOUR: hour, PERIOD_DAY: hour.replace(hour=0)}
+
+
+async def record_usage(
+    db: AsyncSession,
+    chat_id: int,
+    user_id: str,
+    prompt_name: str,
+    cached: bool = False,
+    failed: bool = False,
+    cost: float = 0.0,
+    latency_seconds: float = 0.0,
+):
+    # One upsert per period adds the request to its hourly and daily rows.
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    counters = {
+        "requests": int(not failed),
+        "cache_hits": int(cached and not failed),
+        "failures": int(failed),
+        "cost": cost or 0.0,
+        "latency_seconds": 0.0 if cached or failed else latency_seconds,
+    }
+    for period, period_start in _period_starts(datetime.now(UTC)).items():
+        statement = insert(UsageRollup).values(
+            period=period,
+            period_start=period_start,
+            chat_id=chat_id,
+            user_id=user_id,
+            prompt_name=prompt_name,
+            **counters,
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=ROLLUP_KEY,
+            set_={
+                name: getattr(UsageRollup, name) + statement.excluded[name]
+                for name in COUNTERS
+            },
+        )
+        await db.execute(statement)
+    await db.commit()
+
+
+async def _delete_in_batches(db: AsyncSession, model, condition) -> int:
+    # Large backlogs are removed in batches so that no single statement holds
+    # locks on millions of rows.
+    deleted = 0
+    while True:
+        batch = select(model.id).where(condition).limit(PRUNE_BATCH_SIZE)
+        result = await db.execute(delete(model).where(model.id.in_(batch)))
+        await db.commit()
+        deleted += result.rowcount
+        if result.rowcount < PRUNE_BATCH_SIZE:
+            return deleted
+
+
+async def prune_usage_data(db: AsyncSession) -> tuple[int, int]:
+    now_utc = datetime.now(UTC)
+    log_entries = await _delete_in_batches(
+        db,
+        LogEntry,
+        LogEntry.called_at < now_utc - timedelta(days=settings.log_retention_days),
+    )
+    hourly_rollups = await _delete_in_batches(
+        db,
+        UsageRollup,
+        (UsageRollup.period == PERIOD_HOUR)
+        & (
+            UsageRollup.period_start
+            < now_utc - timedelta(days=settings.usage_hourly_retention_days)
+        ),
+    )
+    return log_entries, hourly_rollups
+
+
+def _summarize(requests, cache_hits, failures, cost, latency_seconds) -> dict:
+    requests, cache_hits, failures = requests or 0, cache_hits or 0, failures or 0
+    summarized = requests - cache_hits
+    return {
+        "requests": requests,
+        "cache_hits": cache_hits,
+        "failures": failures,
+        "cost": cost or 0.0,
+        "cache_hit_rate": cache_hits / requests if requests else 0.0,
+        "avg_latency": (latency_seconds or 0.0) / summarized if summarized else 0.0,
+    }
+
+
+async def get_usage_report(db: AsyncSession, days: int = 7) -> dict:
+    # Reads only rollup rows of the requested window, so the cost depends on
+    # the number of active chats and users, not on how many requests were made.
+    now_utc = datetime.now(UTC)
+    since_day = _period_starts(now_utc)[PERIOD_DAY] - timedelta(days=days - 1)
+    since_hour = _period_starts(now_utc)[PERIOD_HOUR] - timedelta(hours=23)
+    sums = [func.sum(getattr(UsageRollup, name)) for name in COUNTERS]
+
+    def grouped(period: str, since: datetime, *columns):
+        return (
+            select(*columns, *sums)
+            .where(UsageRollup.period == period, UsageRollup.period_start >= since)
+            .group_by(*columns)
+        )
+
+    def top(column):
+        return grouped(PERIOD_DAY, since_day, column).order_by(
+            func.sum(UsageRollup.requests).desc()
+        )
+
+    totals = (await db.execute(grouped(PERIOD_DAY, since_day))).one()
+    hourly = await db.execute(
+        grouped(PERIOD_HOUR, since_hour, UsageRollup.period_start).order_by(
+            UsageRollup.period_start
+        )
+    )
+    report = {
+        "days": days,
+        "totals": _summarize(*totals),
+        "hourly": [(period_start, _summarize(*row)) for period_start, *row in hourly],
+    }
+    for name, column in (
+        ("chats", UsageRollup.chat_id),
+        ("users", UsageRollup.user_id),
+        ("prompts", UsageRollup.prompt_name),
+    ):
+        rows = await db.execute(top(column).limit(REPORT_TOP))
+        report[name] = [(key, _summarize(*row)) for key, *row in rows]
+    return report
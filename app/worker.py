@@ -0,0 +1,485 @@
+import asyncio
+import logging
+import signal
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from telethon.errors import RPCError
+
+from app.database import SessionLocal, dispose_engine, init_db
+from app.loader import settings
+from app.models import SummaryJob
+from app.services import archive as archive_service
+from app.services import digests as digests_service
+from app.services import metrics
+from app.services import jobs as jobs_service
+from app.services import message_store
+from app.services import prompt as prompt_service
+from app.services import rolling as rolling_service
+from app.services import spend as spend_service
+from app.services.logging import log_summary_request
+from app.services.openai import SummaryResponse, close_openai_client
+from app.services.outbound import outbound
+from app.services.streaming import StreamingReply
+from app.services.summarization import (
+    ROLLING_INSTRUCTION,
+    SummarizationError,
+    format_cost_footer,
+    format_digest_message,
+    format_summary_header,
+    format_summary_message,
+    notify_admin,
+    summarize_transcript,
+    with_previous_summary,
+)
+from app.services.rate_limit import rate_limiter, update_rate_limit
+from app.services.summary_cache import store_summary
+from app.services.tracing import configure_logging, set_trace_id
+from app.services.transcript import build_transcript
+from app.services.usage import record_usage
+
+logger = logging.getLogger(__name__)
+
+INTERNAL_ERROR_TEXT = (
+    "@{user_name}, произошла внутренняя ошибка. Не удалось выполнить суммирование."
+)
+TIMEOUT_ERROR_TEXT = (
+    "@{user_name}, не удалось подготовить сводку за {seconds} с. "
+    "Попробуйте позже или уменьшите количество сообщений."
+)
+PARTIAL_SUMMARY_NOTE = "\n\n⏱ Сводка неполная: истекло время ожидания."
+INTERRUPTED_RETRY_NOTE = "\n\n⚠️ Сводка прервана из-за ошибки, готовлю её заново."
+INTERRUPTED_SUMMARY_NOTE = "\n\n⚠️ Сводка прервана из-за ошибки."
+
+
+async def finalize_job(db: AsyncSession, job: SummaryJob):
+    response = SummaryResponse(summary=job.result, cost=job.cost, model=job.model)
+    if job.cache_key:
+        await store_summary(
+            db, job.cache_key, response, job.model or settings.openai_model
+        )
+    if job.coalesced_into is None:
+        # The cooldown was reserved at admission and counts from it.
+        await update_rate_limit(db, str(job.chat_id), job.created_at)
+    await log_summary_request(
+        db,
+        job.user_id,
+        job.chat_id,
+        job.prompt_name,
+        cached=job.coalesced_into is not None,
+        cost=job.cost,
+        latency_seconds=jobs_service.job_latency(job),
+    )
+
+
+async def deliver_digest(bot, job: SummaryJob):
+    if job.status == jobs_service.JOB_COMPLETED:
+        await outbound.send_long_message(
+            bot,
+            job.chat_id,
+            format_digest_message(SummaryResponse(summary=job.result, cost=job.cost)),
+            None,
+        )
+    else:
+        # Digests hold no rate-limit reservations, so there is nothing to release.
+        await notify_admin(
+            bot, f"Не удалось подготовить дайджест чата {job.chat_id}: {job.last_error}"
+        )
+
+
+async def deliver_job(bot, db: AsyncSession, job: SummaryJob):
+    set_trace_id(job.trace_id)
+    try:
+        if job.kind == jobs_service.KIND_DIGEST:
+            await deliver_digest(bot, job)
+            await record_usage(
+                db,
+                job.chat_id,
+                job.user_id,
+                job.prompt_name,
+                failed=job.status != jobs_service.JOB_COMPLETED,
+                cost=job.cost,
+                latency_seconds=jobs_service.job_latency(job),
+            )
+        elif job.status == jobs_service.JOB_COMPLETED:
+            final_message = format_summary_message(
+                job.user_name,
+                SummaryResponse(summary=job.result, cost=job.cost),
+                cached=job.coalesced_into is not None,
+            )
+            await outbound.send_long_message(
+                bot, job.chat_id, final_message, job.reply_to_message_id
+            )
+            await finalize_job(db, job)
+        else:
+            if job.coalesced_into is None:
+                await rate_limiter.release_chat(str(job.chat_id))
+            await rate_limiter.release_user(job.user_id)
+            await outbound.send_message(
+                bot, job.chat_id, job.last_error, reply_to=job.reply_to_message_id
+            )
+            await record_usage(
+                db, job.chat_id, job.user_id, job.prompt_name, failed=True
+            )
+    except RPCError as e:
+        logger.error(f"Ошибка Telegram при отправке сообщения в чат {job.chat_id}: {e}")
+        await notify_admin(
+            bot, f"Не удалось отправить сообщение в чат {job.chat_id}. Ошибка: {e}"
+        )
+    except asyncio.CancelledError:
+        # Left undelivered so the delivery loop picks it up after a restart.
+        raise
+    except Exception:
+        logger.exception(f"Ошибка при доставке результата задачи {job.id}")
+        await db.rollback()
+
+    await jobs_service.mark_delivered(db, job)
+
+
+async def fail_on_deadline(db: AsyncSession, job: SummaryJob, stage: str):
+    metrics.deadline_exceeded.inc(stage=stage)
+    logger.warning(f"Задача {job.id}: истекло время ожидания ({stage})")
+    await jobs_service.fail_job(
+        db,
+        job,
+        TIMEOUT_ERROR_TEXT.format(
+            user_name=job.user_name, seconds=settings.request_timeout_seconds
+        ),
+    )
+
+
+async def close_streamed_reply(job: SummaryJob, reply, note: str):
+    try:
+        await reply.finish(note)
+    except RPCError as e:
+        logger.error(f"Ошибка Telegram при отправке сообщения в чат {job.chat_id}: {e}")
+
+
+async def finish_partial_reply(db: AsyncSession, job: SummaryJob, reply):
+    # The user already sees part of the summary, so it is kept with a note
+    # instead of a separate error message.
+    await close_streamed_reply(job, reply, PARTIAL_SUMMARY_NOTE)
+    await rate_limiter.release_chat(str(job.chat_id))
+    await rate_limiter.release_user(job.user_id)
+    await record_usage(db, job.chat_id, job.user_id, job.prompt_name, failed=True)
+    await jobs_service.mark_delivered(db, job)
+
+
+async def run_job(db: AsyncSession, job: SummaryJob, bot=None):
+    # Requests that waited in the queue past their deadline are dropped
+    # before anything is fetched or paid for.
+    remaining = jobs_service.time_left(job)
+    if remaining is not None and remaining <= 0:
+        await fail_on_deadline(db, job, "queue")
+        return
+
+    prompt = await prompt_service.prompt_registry.get(db, job.prompt_name)
+    if not prompt:
+        await jobs_service.fail_job(
+            db,
+            job,
+            f"@{job.user_name}, тип промпта '{job.prompt_name}' больше не существует.",
+        )
+        return
+
+    messages = await message_store.get_recent_messages(
+        db, job.chat_id, job.num_messages, max_message_id=job.last_message_id
+    )
+    system_prompt = prompt.text
+    previous = None
+    if job.kind == jobs_service.KIND_ROLLING:
+        # Only messages after the stored summary are sent, folded into it.
+        previous = await rolling_service.get_rolling_summary(
+            db, job.chat_id, job.prompt_name
+        )
+        messages = rolling_service.select_new_messages(messages, previous)
+        if previous is not None and not messages:
+            await jobs_service.complete_job(
+                db, job, SummaryResponse(summary=previous.summary, cost=0.0)
+            )
+            return
+
+    transcript = build_transcript(job.chat_id, messages)
+    if previous is not None:
+        transcript = with_previous_summary(transcript, previous.summary)
+        system_prompt += ROLLING_INSTRUCTION
+
+    reply = None
+    if (
+        bot is not None
+        and settings.summary_streaming_enabled
+        and job.kind != jobs_service.KIND_DIGEST
+    ):
+        reply = StreamingReply(
+            bot,
+            job.chat_id,
+            job.reply_to_message_id,
+            format_summary_header(job.user_name),
+        )
+
+    # Ends the read transaction so that no pooled connection sits idle in it
+    # for the whole model call; the results are written in a new one.
+    await db.commit()
+
+    deadline = asyncio.timeout(jobs_service.time_left(job))
+    try:
+        async with deadline:
+            response = await summarize_transcript(
+                transcript,
+                system_prompt,
+                on_delta=reply.append if reply else None,
+                system_prompt_tokens=prompt.token_count or 0,
+                preferred_models=prompt.preferred_models,
+            )
+    except SummarizationError as e:
+        await jobs_service.fail_job(db, job, f"@{job.user_name}, {e}")
+        return
+    except (ConnectionError, TimeoutError) as e:
+        if deadline.expired():
+            await fail_on_deadline(db, job, "llm")
+            if reply is not None and reply.streamed:
+                await finish_partial_reply(db, job, reply)
+            return
+        logger.warning(f"Задача {job.id}: попытка {job.attempts} не удалась: {e}")
+        retrying = await jobs_service.retry_job(db, job, str(e))
+        if reply is not None and reply.streamed:
+            # A retry streams into a new message, so the partial one is
+            # marked as abandoned rather than left looking complete.
+            await close_streamed_reply(
+                job,
+                reply,
+                INTERRUPTED_RETRY_NOTE if retrying else INTERRUPTED_SUMMARY_NOTE,
+            )
+        if not retrying:
+            await jobs_service.fail_job(
+                db, job, INTERNAL_ERROR_TEXT.format(user_name=job.user_name)
+            )
+        return
+    except Exception as e:
+        logger.exception(f"Критическая ошибка при обработке задачи {job.id}")
+        await jobs_service.fail_job(
+            db, job, INTERNAL_ERROR_TEXT.format(user_name=job.user_name)
+        )
+        if bot is not None:
+            await notify_admin(
+                bot,
+                f"Критическая ошибка в боте при запросе от @{job.user_name} "
+                f"в чате {job.chat_id}:\n\n{e}",
+            )
+        return
+
+    await jobs_service.complete_job(db, job, response)
+    await spend_service.record_spend(db, job, response)
+    await archive_service.archive_summary(db, job)
+    if job.kind == jobs_service.KIND_DIGEST:
+        await digests_service.store_digest(db, job)
+        if job.cache_key:
+            await store_summary(
+                db, job.cache_key, response, response.model or settings.openai_model
+            )
+    elif job.kind == jobs_service.KIND_ROLLING:
+        await rolling_service.save_rolling_summary(db, job)
+
+    if reply is not None and reply.streamed:
+        try:
+            await reply.finish(format_cost_footer(response))
+            await finalize_job(db, job)
+        except RPCError as e:
+            logger.error(
+                f"Ошибка Telegram при отправке сообщения в чат {job.chat_id}: {e}"
+            )
+        await jobs_service.mark_delivered(db, job)
+
+
+class WorkerPool:
+    def __init__(self, bot=None, size: int = settings.job_workers):
+        self.bot = bot
+        self.size = size
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._active_jobs: dict[int, asyncio.Task] = {}
+        self._draining = False
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def start(self):
+        self._draining = False
+        self._tasks = [
+            asyncio.create_task(self._worker_loop(index)) for index in range(self.size)
+        ]
+        self._tasks.append(asyncio.create_task(self._maintenance_loop()))
+        self._tasks.append(asyncio.create_task(self._cancellation_loop()))
+        if self.bot is not None:
+            self._tasks.append(asyncio.create_task(self._delivery_loop()))
+        logger.info(f"Запущено обработчиков очереди: {self.size}")
+
+    async def stop(self, grace_seconds: float = 0):
+        # Workers stop claiming new jobs and get up to grace_seconds to finish
+        # and deliver the ones in flight. Whatever is still running after
+        # that is put back in the queue for another process.
+        self._draining = True
+        self._wakeup.set()
+        workers = self._tasks[: self.size]
+        if workers and grace_seconds > 0:
+            logger.info(f"Ожидание завершения задач: {len(self._active_jobs)}")
+            await asyncio.wait(workers, timeout=grace_seconds)
+
+        interrupted = list(self._active_jobs)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if interrupted:
+            async with SessionLocal() as db:
+                released = await jobs_service.release_jobs(db, interrupted)
+            logger.warning(f"Возвращено в очередь прерванных задач: {released}")
+
+    def cancel(self, job_ids: list[int]):
+        for job_id in job_ids:
+            task = self._active_jobs.get(job_id)
+            if task is not None:
+                task.cancel()
+
+    async def _run(self, db: AsyncSession, job: SummaryJob) -> bool:
+        # The job runs in its own task so that /cancel stops it without
+        # stopping the worker. Returns False if it was cancelled.
+        job_id = job.id
+        task = asyncio.create_task(run_job(db, job, self.bot))
+        self._active_jobs[job_id] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            logger.info(f"Задача {job_id} отменена")
+            # Expires the job, so nothing may read it after this.
+            await db.rollback()
+            return False
+        finally:
+            self._active_jobs.pop(job_id, None)
+        return True
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(
+                self._wakeup.wait(), timeout=settings.job_poll_interval_seconds
+            )
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _worker_loop(self, index: int):
+        while not self._draining:
+            job = None
+            db = SessionLocal()
+            try:
+                job = await jobs_service.claim_next_job(db)
+                if job is not None:
+                    set_trace_id(job.trace_id)
+                    logger.info(
+                        f"Обработчик {index}: задача {job.id}, чат {job.chat_id}"
+                    )
+                    metrics.stage_seconds.observe(
+                        (job.started_at - job.created_at).total_seconds(),
+                        stage="queue_wait",
+                    )
+                    with metrics.stage_seconds.time(stage="job"):
+                        finished = await self._run(db, job)
+                    if finished and self.bot is not None and self._is_deliverable(job):
+                        await deliver_job(self.bot, db, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Ошибка в обработчике очереди {index}")
+                await asyncio.sleep(settings.job_poll_interval_seconds)
+            finally:
+                await db.close()
+
+            if job is None and not self._draining:
+                await self._wait()
+
+    @staticmethod
+    def _is_deliverable(job: SummaryJob) -> bool:
+        return job.delivered_at is None and job.status in (
+            jobs_service.JOB_COMPLETED,
+            jobs_service.JOB_FAILED,
+        )
+
+    async def _delivery_loop(self):
+        while True:
+            db = SessionLocal()
+            try:
+                for job in await jobs_service.get_undelivered_jobs(db):
+                    if job.id not in self._active_jobs:
+                        await deliver_job(self.bot, db, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка при доставке результатов")
+            finally:
+                await db.close()
+            await asyncio.sleep(settings.job_poll_interval_seconds)
+
+    async def _cancellation_loop(self):
+        # Jobs may be cancelled from another process; the bot process also
+        # calls cancel() directly.
+        while True:
+            await asyncio.sleep(settings.job_poll_interval_seconds)
+            if not self._active_jobs:
+                continue
+            db = SessionLocal()
+            try:
+                self.cancel(
+                    await jobs_service.get_cancelled_job_ids(
+                        db, list(self._active_jobs)
+                    )
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка при проверке отменённых задач")
+            finally:
+                await db.close()
+
+    async def _maintenance_loop(self):
+        while True:
+            db = SessionLocal()
+            try:
+                requeued = await jobs_service.requeue_stale_jobs(db)
+                if requeued:
+                    logger.warning(f"Возвращено в очередь зависших задач: {requeued}")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка при обслуживании очереди")
+            finally:
+                await db.close()
+            await asyncio.sleep(settings.job_stale_after_seconds / 2)
+
+
+def add_shutdown_signal_handlers(shutdown: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, shutdown.set)
+
+
+async def run_standalone_workers():
+    shutdown = asyncio.Event()
+    add_shutdown_signal_handlers(shutdown)
+
+    await init_db()
+    pool = WorkerPool(bot=None)
+    await pool.start()
+    try:
+        await shutdown.wait()
+        logger.info("Остановка обработчиков очереди...")
+    finally:
+        await pool.stop(settings.shutdown_grace_seconds)
+        await close_openai_client()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    asyncio.run(run_standalone_workers())
@@ -0,0 +1,323 @@
+"""
+Load test of /summarize without Telegram and OpenAI.
+
+Requests from a JSONL corpus are replayed through telegram_bot.summarize with
+a fake TelegramClient (its latency and FloodWaits are configurable) and the
+built-in OpenAI stub. For every concurrency level the test prints p50/p95/p99,
+req/s and the number of database queries per request:
+
+    python -m benchmarks.loadtest requests.jsonl -n 100 -c 1 4 16
+    python -m benchmarks.loadtest requests.jsonl --tg-latency 0.05 --flood-rate 0.02
+
+Every corpus line is a JSON object with a text field (or title/body); the
+lines make up the chat histories. Rate limits and streamed replies are turned
+off: a request is done once the bot has sent its reply to the command.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, UTC, timedelta
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+WORK_DIR = tempfile.mkdtemp()
+
+os.environ.setdefault("ADMIN_USERNAME", "bench")
+os.environ.setdefault("ADMIN_PASSWORD", "bench")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("OPENAI_BASE_URL", "http://127.0.0.1:8082/v1")
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "bench")
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(WORK_DIR, "loadtest.db"),
+)
+# Importing the bot creates Telethon session files; they must not touch the
+# real ones.
+os.environ["TELEGRAM_SESSION"] = os.path.join(WORK_DIR, "loadtest")
+os.environ["TELEGRAM_EXTRA_SESSIONS"] = "[]"
+os.environ.setdefault("USER_REQUEST_LIMIT_PER_HOUR", "1000000")
+os.environ.setdefault("THREAD_REQUEST_COOLDOWN_HOURS", "0")
+os.environ["SUMMARY_STREAMING_ENABLED"] = "false"
+
+import uvicorn  # noqa: E402
+from sqlalchemy import event, select  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from telethon.errors import FloodWaitError  # noqa: E402
+
+import telegram_bot  # noqa: E402
+from app.database import SessionLocal, dispose_engine, init_db  # noqa: E402
+from app.loader import settings  # noqa: E402
+from app.models import Prompt  # noqa: E402
+from app.services.openai import close_openai_client  # noqa: E402
+from benchmarks import openai_stub  # noqa: E402
+
+PROMPT_NAME = "loadtest"
+USERS = 50
+
+query_count = 0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(*args):
+    global query_count
+    query_count += 1
+
+
+def load_corpus(path: str) -> list[str]:
+    texts = []
+    with open(path, encoding="utf8") as corpus:
+        for line in corpus:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = record.get("text") or " ".join(
+                filter(None, (record.get("title"), record.get("body")))
+            )
+            if text:
+                texts.append(text)
+    if not texts:
+        raise SystemExit(f"В корпусе {path} нет текстов")
+    return texts
+
+
+class FakeTelegramClient:
+    def __init__(
+        self, corpus: list[str], latency: float, flood_rate: float, flood_seconds: int
+    ):
+        self.corpus = itertools.cycle(corpus)
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.chats: dict[int, list] = {}
+        self.waiters: dict[int, asyncio.Future] = {}
+        self.flood_waits = 0
+        self._ids = itertools.count(1)
+        self._started_at = datetime.now(UTC) - timedelta(days=1)
+
+    def add_message(self, chat_id: int):
+        message_id = next(self._ids)
+        sender_id = message_id % USERS + 1
+        message = SimpleNamespace(
+            id=message_id,
+            sender_id=sender_id,
+            sender=SimpleNamespace(username=f"user{sender_id}"),
+            text=next(self.corpus),
+            date=self._started_at + timedelta(seconds=message_id),
+        )
+        self.chats.setdefault(chat_id, []).append(message)
+        return message
+
+    def resolve(self, reply_to: int | None, outcome: str):
+        waiter = self.waiters.get(reply_to)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(outcome)
+
+    async def _call(self):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def get_messages(self, chat_id, limit, min_id=0, offset_id=0, **kwargs):
+        await self._call()
+        messages = [
+            message
+            for message in reversed(self.chats.get(chat_id, []))
+            if message.id > min_id and (not offset_id or message.id < offset_id)
+        ]
+        return messages[:limit]
+
+    async def get_entity(self, ids):
+        await self._call()
+        return [SimpleNamespace(username=f"user{sender_id}") for sender_id in ids]
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        # The bot retries sends after a FloodWait itself, so a request is done
+        # only once a send actually goes through.
+        await self._call()
+        self.resolve(reply_to, "ok" if "Краткая сводка" in text else "error")
+        return SimpleNamespace(id=next(self._ids))
+
+    async def edit_message(self, chat_id, message, text, **kwargs):
+        await self._call()
+        return message
+
+
+class FakeEvent:
+    def __init__(self, bot: FakeTelegramClient, chat_id: int, message, user_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = message
+        self.user_id = user_id
+
+    async def get_sender(self):
+        return SimpleNamespace(
+            id=self.user_id, username=f"user{self.user_id}", first_name=None
+        )
+
+    async def reply(self, text, **kwargs):
+        if not text.startswith("✅"):
+            self.bot.resolve(self.message.id, "rejected")
+
+
+def start_openai_stub(latency: float):
+    openai_stub.app.state.latency = latency
+    server = uvicorn.Server(
+        uvicorn.Config(
+            openai_stub.app,
+            port=urlparse(settings.openai_base_url).port,
+            log_level="warning",
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_level(
+    bot: FakeTelegramClient, args, concurrency: int, chat_base: int
+) -> dict:
+    limiter = asyncio.Semaphore(concurrency)
+    latencies = []
+    outcomes: dict[str, int] = {}
+
+    async def one(index: int):
+        chat_id = chat_base + index % args.chats
+        async with limiter:
+            new_message = bot.add_message(chat_id)
+            await telegram_bot.store_new_message(
+                FakeEvent(bot, chat_id, new_message, new_message.sender_id)
+            )
+
+            command = SimpleNamespace(
+                id=next(bot._ids),
+                text=f"/summarize {PROMPT_NAME} {args.messages}",
+            )
+            waiter = asyncio.get_running_loop().create_future()
+            bot.waiters[command.id] = waiter
+
+            started = time.perf_counter()
+            try:
+                await telegram_bot.summarize(
+                    FakeEvent(bot, chat_id, command, index % USERS + 1)
+                )
+                outcome = await asyncio.wait_for(waiter, timeout=args.timeout)
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+            except FloodWaitError:
+                outcome = "floodwait"
+            finally:
+                bot.waiters.pop(command.id, None)
+
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome == "ok":
+                latencies.append(time.perf_counter() - started)
+
+    queries_before = query_count
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(args.total)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "outcomes": outcomes,
+        "queries": query_count - queries_before,
+    }
+
+
+def print_report(result: dict, total: int):
+    latencies = result["latencies"]
+    outcomes = ", ".join(f"{k}={v}" for k, v in sorted(result["outcomes"].items()))
+    print(f"параллельно: {result['concurrency']}")
+    print(
+        f"  {total / result['elapsed']:.1f} req/s за {result['elapsed']:.2f}s "
+        f"({outcomes})"
+    )
+    if latencies:
+        print(
+            f"  p50: {statistics.median(latencies):.3f}s, "
+            f"p95: {percentile(latencies, 0.95):.3f}s, "
+            f"p99: {percentile(latencies, 0.99):.3f}s"
+        )
+    print(f"  запросов к БД на запрос: {result['queries'] / total:.1f}")
+
+
+async def run(args):
+    corpus = load_corpus(args.corpus)
+    bot = FakeTelegramClient(
+        corpus, args.tg_latency, args.flood_rate, args.flood_seconds
+    )
+    telegram_bot.bot = bot
+    telegram_bot.worker_pool.bot = bot
+
+    await init_db()
+    async with SessionLocal() as db:
+        if not await db.scalar(select(Prompt).where(Prompt.name == PROMPT_NAME)):
+            db.add(Prompt(name=PROMPT_NAME, text="Сделай краткую сводку переписки."))
+            await db.commit()
+        await telegram_bot.rate_limiter.load(db)
+
+    # Every chat gets its history up front so the first requests are no
+    # different from the rest.
+    chat_bases = [level * 1_000_000 for level in range(1, len(args.concurrency) + 1)]
+    for chat_base in chat_bases:
+        for chat_id in range(chat_base, chat_base + args.chats):
+            for _ in range(args.messages):
+                bot.add_message(chat_id)
+
+    await telegram_bot.worker_pool.start()
+    try:
+        for concurrency, chat_base in zip(args.concurrency, chat_bases):
+            print_report(await run_level(bot, args, concurrency, chat_base), args.total)
+    finally:
+        await telegram_bot.worker_pool.stop()
+        await close_openai_client()
+        await dispose_engine()
+
+    if bot.flood_waits:
+        print(f"FloodWait: {bot.flood_waits}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("corpus", help="JSONL-файл с текстами сообщений")
+    parser.add_argument("-n", "--total", type=int, default=50)
+    parser.add_argument("-c", "--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--tg-latency", type=float, default=0.02)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--flood-seconds", type=int, default=5)
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument(
+        "--external-openai",
+        action="store_true",
+        help="не запускать встроенную заглушку, использовать OPENAI_BASE_URL",
+    )
+    args = parser.parse_args()
+
+    if not args.external_openai:
+        start_openai_stub(args.openai_latency)
+    asyncio.run(run(args))
@@ -0,0 +1,58 @@
+"""
+Замер пропускной способности get_summary_from_openai под нагрузкой.
+
+Запустите заглушку и затем бенчмарк:
+
+    python -m benchmarks.openai_stub --latency 1.0
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 python -m benchmarks.openai_concurrency -n 200 -c 50
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault("ADMIN_USERNAME", "bench")
+os.environ.setdefault("ADMIN_PASSWORD", "bench")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("OPENAI_BASE_URL", "http://127.0.0.1:8081/v1")
+os.environ.setdefault("TELEGRAM_API_ID", "0")
+os.environ.setdefault("TELEGRAM_API_HASH", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from app.services.openai import close_openai_client, get_summary_from_openai  # noqa: E402
+
+
+async def run(total: int, concurrency: int):
+    limiter = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with limiter:
+            started = time.perf_counter()
+            await get_summary_from_openai(f"Сообщение {i}\n" * 50, "Сделай сводку.")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    await close_openai_client()
+
+    latencies.sort()
+    print(f"запросов: {total}, параллельно: {concurrency}")
+    print(f"общее время: {elapsed:.2f}s, {total / elapsed:.1f} req/s")
+    print(
+        f"p50: {statistics.median(latencies):.3f}s, "
+        f"p95: {latencies[int(len(latencies) * 0.95) - 1]:.3f}s, "
+        f"max: {latencies[-1]:.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--total", type=int, default=100)
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.total, args.concurrency))
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+app = FastAPI()
+app.state.latency = 1.0
+app.state.completion_tokens = 200
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    prompt_chars = sum(len(m.get("content") or "") for m in payload.get("messages", []))
+    prompt_tokens = max(1, prompt_chars // 4)
+    completion_tokens = app.state.completion_tokens
+
+    if payload.get("stream"):
+        return StreamingResponse(
+            _stream_completion(payload, prompt_tokens, completion_tokens),
+            media_type="text/event-stream",
+        )
+
+    await asyncio.sleep(app.state.latency)
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "stub"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": "Заглушка сводки. " * (completion_tokens // 4),
+                },
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+async def _stream_completion(payload: dict, prompt_tokens: int, completion_tokens: int):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    chunks = completion_tokens // 4
+    base = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": payload.get("model", "stub"),
+    }
+
+    for index in range(chunks):
+        await asyncio.sleep(app.state.latency / chunks)
+        content = "Заглушка сводки. " + ("\n" if index % 10 == 9 else "")
+        chunk = {
+            **base,
+            "choices": [
+                {"index": 0, "delta": {"content": content}, "finish_reason": None}
+            ],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+    usage_chunk = {
+        **base,
+        "choices": [],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+    yield f"data: {json.dumps(usage_chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Локальная заглушка OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    args = parser.parse_args()
+
+    app.state.latency = args.latency
+    app.state.completion_tokens = args.completion_tokens
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,98 @@
+"""
+Замер сборки транскрипта и подсчёта токенов.
+
+Сравнивает старый путь (конкатенация строк и кодирование всего текста)
+с build_transcript: холодный запуск, повтор и повтор с новыми сообщениями.
+
+    python -m benchmarks.transcript_bench --sizes 200 5000
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("ADMIN_USERNAME", "bench")
+os.environ.setdefault("ADMIN_PASSWORD", "bench")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("TELEGRAM_API_ID", "0")
+os.environ.setdefault("TELEGRAM_API_HASH", "bench")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import tiktoken  # noqa: E402
+
+from app.services.transcript import (  # noqa: E402
+    build_transcript,
+    format_message,
+    get_encoding,
+    line_token_cache,
+)
+
+NEW_MESSAGES = 20
+
+
+def make_messages(count: int, start_id: int = 1) -> list[dict]:
+    started_at = datetime(2024, 1, 1)
+    return [
+        {
+            "id": message_id,
+            "sender_id": message_id % 7,
+            "user": f"user{message_id % 7}",
+            "text": f"Сообщение номер {message_id}: обсуждаем релиз и сроки. " * 3,
+            "date": (started_at + timedelta(minutes=message_id)).isoformat(),
+        }
+        for message_id in range(start_id, start_id + count)
+    ]
+
+
+def baseline(messages: list[dict]) -> int:
+    formatted_text = ""
+    for msg in messages:
+        formatted_text += format_message(msg)
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(formatted_text))
+
+
+def measure(func, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def run(size: int, repeat: int):
+    messages = make_messages(size)
+    # Следующий запрос: окно сдвинулось на NEW_MESSAGES сообщений.
+    shifted = messages[NEW_MESSAGES:] + make_messages(NEW_MESSAGES, size + 1)
+
+    get_encoding()
+    line_token_cache.clear()
+    cold = measure(lambda: build_transcript(1, messages), 1)
+    warm = measure(lambda: build_transcript(1, messages), repeat)
+    incremental = measure(lambda: build_transcript(1, shifted), 1)
+    old = measure(lambda: baseline(messages), repeat)
+
+    transcript = build_transcript(1, messages)
+    print(f"сообщений: {size}")
+    if transcript.original_token_count is not None:
+        print(
+            f"  токенов: {transcript.original_token_count} -> "
+            f"{transcript.token_count} после сжатия"
+        )
+    for label, elapsed in (
+        ("конкатенация + полный encode", old),
+        ("build_transcript, холодный", cold),
+        ("build_transcript, повтор", warm),
+        (f"+{NEW_MESSAGES} новых сообщений", incremental),
+    ):
+        print(f"  {label + ':':<32}{elapsed:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 5000])
+    parser.add_argument("-r", "--repeat", type=int, default=10)
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.repeat)
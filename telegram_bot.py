@@ -1,45 +1,101 @@
 import asyncio
 import logging
 import shlex
+from datetime import datetime, UTC, timedelta
 from functools import wraps
 
-from sqlalchemy.orm import Session
-from telethon import TelegramClient, events
+from sqlalchemy.ext.asyncio import AsyncSession
+from telethon import events
 
-from app.database import SessionLocal
+from app.database import SessionLocal, dispose_engine, init_db
 from app.loader import settings
+from app.services import archive as archive_service
 from app.services import prompt as prompt_service
+from app.services import rolling as rolling_service
+from app.services import spend as spend_service
+from app.services.client_pool import create_client_pool
+from app.services import message_store
+from app.services.history import resolve_sender_names, to_compact_message
+from app.services.leader import LeaderLock
+from app.services.llm_router import llm_router
 from app.services.logging import log_summary_request
+from app.services.openai import SummaryResponse, close_openai_client
+from app.services.outbound import outbound
+from app.services import digests as digests_service
+from app.services import metrics
+from app.services import jobs as jobs_service
+from app.services.rate_limit import rate_limiter
+from app.services.singleflight import SingleFlight
 from app.services.summarization import (
-    check_user_rate_limit,
-    process_summarization_request,
-    update_rate_limit,
-    check_rate_limit,
+    format_digest_message,
+    format_summary_message,
 )
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+from app.services.summary_cache import get_cached_summary, make_cache_key
+from app.services.tracing import (
+    configure_logging,
+    get_trace_id,
+    new_trace_id,
+    set_trace_id,
 )
+from app.services.transcript import build_transcript
+from app.scheduler import DigestScheduler, RetentionScheduler
+from app.worker import WorkerPool, add_shutdown_signal_handlers
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
-bot = TelegramClient(
-    "user_session", settings.telegram_api_id, settings.telegram_api_hash
-)
+bot = create_client_pool()
+# Sorted, so processes sharing some of the sessions take the locks in the same
+# order and cannot deadlock.
+leader_locks = [LeaderLock(name) for name in sorted(bot.session_names)]
+worker_pool = WorkerPool(bot)
+digest_scheduler = DigestScheduler(bot)
+retention_scheduler = RetentionScheduler()
+history_flight = SingleFlight()
+admission_flight = SingleFlight()
+
+bot_loop: asyncio.AbstractEventLoop | None = None
+shutdown_event: asyncio.Event | None = None
 
 
 def get_db(func):
     @wraps(func)
     async def wrapper(event):
-        db = SessionLocal()
-        try:
+        async with SessionLocal() as db:
             return await func(event, db=db)
-        finally:
-            db.close()
 
     return wrapper
 
 
+@bot.on(events.NewMessage())
+@get_db
+async def store_new_message(event, db: AsyncSession = None):
+    if event.chat_id not in message_store.tracked_chats or not event.message.text:
+        return
+
+    names = await resolve_sender_names(bot, event.chat_id, [event.message])
+    await message_store.save_messages(
+        db,
+        event.chat_id,
+        [
+            to_compact_message(
+                event.message, names.get(event.message.sender_id, "Unknown")
+            )
+        ],
+    )
+
+
+@bot.on(events.MessageEdited())
+@get_db
+async def store_edited_message(event, db: AsyncSession = None):
+    if event.chat_id not in message_store.tracked_chats or not event.message.text:
+        return
+
+    await message_store.update_message_text(
+        db, event.chat_id, event.message.id, event.message.text
+    )
+
+
 @bot.on(events.NewMessage(pattern="/start"))
 async def start(event):
     await event.reply(
@@ -56,17 +112,40 @@ async def help_command(event):
         "2. Для суммирования вызовите команду:\n"
         "`/summarize <тип_промпта> [количество_сообщений]`\n\n"
         "   - `<тип_промпта>`: обязательный параметр. Указывает, какой системный промпт использовать (например, `general`).\n"
-        "   - `[количество_сообщений]`: необязательный параметр. По умолчанию — **100**. Максимум — **200**.\n\n"
+        "   - `[количество_сообщений]`: необязательный параметр. По умолчанию — **100**. "
+        f"Максимум — **{settings.max_messages_per_request}**.\n\n"
         "**Примеры:**\n"
         "- `/summarize general` — получить сводку по последним 100 сообщениям.\n"
-        "- `/summarize meetings 50` — получить сводку по последним 50 сообщениям с промптом `meetings`."
+        "- `/summarize meetings 50` — получить сводку по последним 50 сообщениям с промптом `meetings`.\n"
+        "- `/summarize general new` — обновить предыдущую сводку с промптом `general` только новыми сообщениями.\n\n"
+        "**Дайджесты:**\n"
+        "`/subscribe <тип_промпта> [daily|количество_сообщений]` — получать дайджест чата раз в сутки "
+        "или после указанного числа новых сообщений. Пока дайджест свежий, `/summarize` с этим промптом "
+        "без указания количества сразу возвращает его.\n"
+        "`/unsubscribe [тип_промпта]` — отменить подписку.\n\n"
+        "`/cancel` — отменить ваш запрос на сводку, который ещё готовится.\n\n"
+        "**Архив сводок:**\n"
+        "`/find <запрос> [prompt:<тип_промпта>] [days:<N>] [since:<ГГГГ-ММ-ДД>] [until:<ГГГГ-ММ-ДД>]` — "
+        "найти прошлые сводки и дайджесты этого чата без нового суммирования.\n"
+        "Пример: `/find решили days:7` — что решали за последнюю неделю."
     )
     await event.reply(help_text, parse_mode="md")
 
 
+async def reply_user_rate_limited(event):
+    metrics.rate_limit_rejections.inc(scope="user")
+    await event.reply(
+        f"Вы превысили лимит запросов ({settings.user_request_limit_per_hour} в час). Попробуйте позже."
+    )
+
+
 @bot.on(events.NewMessage(pattern="/summarize"))
 @get_db
-async def summarize(event, db: Session = None):
+async def summarize(event, db: AsyncSession = None):
+    set_trace_id(new_trace_id())
+    deadline_at = datetime.now(UTC) + timedelta(
+        seconds=settings.request_timeout_seconds
+    )
     user = await event.get_sender()
     chat_id = event.chat_id
 
@@ -76,34 +155,29 @@ async def summarize(event, db: Session = None):
             raise ValueError
 
         prompt_type = parts[1]
-        num_messages = int(parts[2]) if len(parts) == 3 else 100
+        rolling = len(parts) == 3 and parts[2] == "new"
+        num_messages = int(parts[2]) if len(parts) == 3 and not rolling else 100
 
     except (ValueError, IndexError):
         await event.reply(
-            "Неверный формат команды. Используйте: `/summarize <тип_промпта> [кол-во сообщений]`\n"
+            "Неверный формат команды. Используйте: `/summarize <тип_промпта> [кол-во сообщений|new]`\n"
             "Для справки введите /help."
         )
         return
 
-    if not (0 < num_messages <= 200):
-        await event.reply("Количество сообщений должно быть от 1 до 200.")
-        return
-
-    if not check_user_rate_limit(db, str(user.id)):
+    if not (0 < num_messages <= settings.max_messages_per_request):
         await event.reply(
-            f"Вы превысили лимит запросов ({settings.user_request_limit_per_hour} в час). Попробуйте позже."
+            f"Количество сообщений должно быть от 1 до {settings.max_messages_per_request}."
         )
         return
 
-    if not check_rate_limit(db, str(chat_id)):
-        await event.reply(
-            f"Для этого чата суммирование было недавно. Попробуйте через {settings.thread_request_cooldown_hours}ч."
-        )
+    if not await rate_limiter.check_user(str(user.id)):
+        await reply_user_rate_limited(event)
         return
 
-    prompt = prompt_service.get_prompt_by_name(db, prompt_type)
+    prompt = await prompt_service.prompt_registry.get(db, prompt_type)
     if not prompt:
-        all_prompts = prompt_service.get_all_prompts(db)
+        all_prompts = await prompt_service.prompt_registry.all(db)
         error_text = f"Тип промпта '{prompt_type}' не найден."
         if all_prompts:
             available_types = ", ".join(f"`{p.name}`" for p in all_prompts)
@@ -111,23 +185,67 @@ async def summarize(event, db: Session = None):
         await event.reply(error_text, parse_mode="md")
         return
 
-    await event.reply(
-        f"✅ Принято! Анализирую последние {num_messages} сообщений. Это может занять несколько минут..."
-    )
+    if len(parts) == 2:
+        digest = await digests_service.get_fresh_digest(db, chat_id, prompt.name)
+        if digest and await rate_limiter.reserve_user(str(user.id)):
+            metrics.cache_requests.inc(cache="digest", result="hit")
+            await outbound.send_long_message(
+                bot,
+                chat_id,
+                format_digest_message(digest),
+                event.message.id,
+            )
+            await log_summary_request(
+                db, str(user.id), chat_id, prompt.name, cached=True
+            )
+            return
+
+    # Users in a busy chat often ask at the same moment; they share one fetch.
+    try:
+        async with asyncio.timeout((deadline_at - datetime.now(UTC)).total_seconds()):
+            messages_to_process, _ = await history_flight.do(
+                (chat_id, num_messages),
+                lambda: message_store.sync_chat_history(bot, db, chat_id, num_messages),
+            )
+    except TimeoutError:
+        metrics.deadline_exceeded.inc(stage="fetch")
+        await event.reply(
+            "Не удалось загрузить историю чата вовремя. Попробуйте позже."
+        )
+        return
+    user_name = user.username or user.first_name
 
-    messages = await bot.get_messages(event.chat_id, limit=num_messages)
-    messages_to_process = []
-    for message in reversed(messages):
-        if message.text:
-            sender = await message.get_sender()
-            username = sender.username or sender.first_name or "Unknown"
-            messages_to_process.append(
-                {
-                    "user": username,
-                    "text": message.text,
-                    "date": message.date.isoformat(),
-                }
+    if rolling:
+        rolling_summary = await rolling_service.get_rolling_summary(
+            db, chat_id, prompt.name
+        )
+        if rolling_summary is not None:
+            messages_to_process = await message_store.get_recent_messages(
+                db,
+                chat_id,
+                settings.max_messages_per_request,
+                min_message_id=rolling_summary.last_message_id,
             )
+            if not messages_to_process:
+                if not await rate_limiter.reserve_user(str(user.id)):
+                    await reply_user_rate_limited(event)
+                    return
+                metrics.cache_requests.inc(cache="rolling", result="hit")
+                await outbound.send_long_message(
+                    bot,
+                    chat_id,
+                    format_summary_message(
+                        user_name,
+                        SummaryResponse(summary=rolling_summary.summary, cost=0.0),
+                        cached=True,
+                    ),
+                    event.message.id,
+                )
+                await log_summary_request(
+                    db, str(user.id), chat_id, prompt.name, cached=True
+                )
+                return
+        num_messages = len(messages_to_process)
 
     if not messages_to_process:
         await event.reply(
@@ -135,27 +253,297 @@ async def summarize(event, db: Session = None):
         )
         return
 
-    is_sent = await process_summarization_request(
-        bot=bot,
-        chat_id=chat_id,
-        messages=messages_to_process,
-        user_name=user.username or user.first_name,
-        system_prompt=prompt.text,
-        reply_to_message_id=event.message.id,
+    cache_key = None
+    if not rolling:
+        transcript = build_transcript(chat_id, messages_to_process)
+        cache_key = make_cache_key(
+            transcript.text,
+            prompt.text,
+            llm_router.routing_key(prompt.preferred_models),
+        )
+
+    if not await rate_limiter.reserve_user(str(user.id)):
+        await reply_user_rate_limited(event)
+        return
+
+    cached_response = None
+    if cache_key:
+        cached_response = await get_cached_summary(db, cache_key)
+    if cached_response:
+        await outbound.send_long_message(
+            bot,
+            chat_id,
+            format_summary_message(user_name, cached_response, cached=True),
+            event.message.id,
+        )
+        await log_summary_request(db, str(user.id), chat_id, prompt.name, cached=True)
+        return
+
+    budget_error = await spend_service.spend_tracker.check(db, chat_id, str(user.id))
+    if budget_error:
+        await rate_limiter.release_user(str(user.id))
+        metrics.rate_limit_rejections.inc(scope="budget")
+        await event.reply(f"Суммирование недоступно: {budget_error}.")
+        return
+
+    kind = jobs_service.KIND_ROLLING if rolling else jobs_service.KIND_REQUEST
+
+    async def admit():
+        leader = await jobs_service.find_coalescable_job(
+            db, chat_id, prompt.name, kind, num_messages
+        )
+        if leader is not None:
+            return leader, False
+        if not await rate_limiter.reserve_chat(str(chat_id)):
+            return None, False
+
+        job = await jobs_service.enqueue_job(
+            db,
+            chat_id=chat_id,
+            user_id=str(user.id),
+            user_name=user_name,
+            prompt_name=prompt.name,
+            num_messages=num_messages,
+            last_message_id=messages_to_process[-1]["id"],
+            reply_to_message_id=event.message.id,
+            cache_key=cache_key,
+            kind=kind,
+            trace_id=get_trace_id(),
+            deadline_at=deadline_at,
+        )
+        worker_pool.notify()
+        return job, True
+
+    # Identical requests admitted together share one job: the first one
+    # reserves the chat cooldown and enqueues it, the others join it.
+    (job, created), shared = await admission_flight.do(
+        (chat_id, prompt.name, kind, None if rolling else num_messages), admit
     )
+    if job is None:
+        await rate_limiter.release_user(str(user.id))
+        metrics.rate_limit_rejections.inc(scope="chat")
+        await event.reply(
+            f"Для этого чата суммирование было недавно. Попробуйте через {settings.thread_request_cooldown_hours}ч."
+        )
+        return
+
+    if shared or not created:
+        await jobs_service.join_job(
+            db,
+            job,
+            user_id=str(user.id),
+            user_name=user_name,
+            reply_to_message_id=event.message.id,
+            trace_id=get_trace_id(),
+        )
+        metrics.cache_requests.inc(cache="inflight", result="hit")
+        await event.reply(
+            "✅ Такая же сводка уже готовится по другому запросу. Пришлю результат и вам."
+        )
+        return
+
+    reply_text = f"✅ Принято! Анализирую последние {num_messages} сообщений. Это может занять несколько минут..."
+    if rolling:
+        reply_text = (
+            f"✅ Принято! Обновляю сводку с учётом {num_messages} новых сообщений..."
+        )
+    jobs_ahead = await jobs_service.count_jobs_ahead(db, job)
+    if jobs_ahead:
+        reply_text += f"\nЗапросов в очереди перед вашим: {jobs_ahead}."
+    await event.reply(reply_text)
 
-    if is_sent:
-        update_rate_limit(db, str(chat_id))
-        log_summary_request(db, user_id=user.id, root_post_id=str(chat_id))
+
+@bot.on(events.NewMessage(pattern="/cancel"))
+@get_db
+async def cancel(event, db: AsyncSession = None):
+    user = await event.get_sender()
+    jobs = await jobs_service.cancel_user_jobs(db, event.chat_id, str(user.id))
+    if not jobs:
+        await event.reply("У вас нет запросов на суммирование, которые ещё готовятся.")
+        return
+
+    worker_pool.cancel([job.id for job in jobs])
+    for job in jobs:
+        if job.coalesced_into is None:
+            await rate_limiter.release_chat(str(job.chat_id))
+        await rate_limiter.release_user(job.user_id)
+    await event.reply("Запрос на суммирование отменён.")
+
+
+@bot.on(events.NewMessage(pattern="/find"))
+@get_db
+async def find(event, db: AsyncSession = None):
+    try:
+        text, filters = archive_service.parse_search_filters(
+            shlex.split(event.message.text)[1:]
+        )
+        if not text and not filters:
+            raise ValueError
+    except ValueError:
+        await event.reply(
+            "Неверный формат команды. Используйте: `/find <запрос> [prompt:<тип_промпта>] "
+            "[days:<N>] [since:<ГГГГ-ММ-ДД>] [until:<ГГГГ-ММ-ДД>]`"
+        )
+        return
+
+    entries = await archive_service.search_summaries(
+        db, text, chat_id=event.chat_id, **filters
+    )
+    if not entries:
+        await event.reply("В архиве сводок этого чата ничего не найдено.")
+        return
+    await outbound.send_long_message(
+        bot,
+        event.chat_id,
+        archive_service.format_search_results(entries, text),
+        event.message.id,
+    )
+
+
+@bot.on(events.NewMessage(pattern="/subscribe"))
+@get_db
+async def subscribe(event, db: AsyncSession = None):
+    user = await event.get_sender()
+    try:
+        parts = shlex.split(event.message.text)
+        if not (2 <= len(parts) <= 3):
+            raise ValueError
+        prompt_type = parts[1]
+        mode = parts[2] if len(parts) == 3 else "daily"
+        every_messages = None if mode == "daily" else int(mode)
+    except ValueError:
+        await event.reply(
+            "Неверный формат команды. Используйте: `/subscribe <тип_промпта> [daily|кол-во сообщений]`"
+        )
+        return
+
+    if every_messages is not None and not (
+        settings.digest_min_every_messages
+        <= every_messages
+        <= settings.digest_max_messages
+    ):
+        await event.reply(
+            f"Количество сообщений должно быть от {settings.digest_min_every_messages} "
+            f"до {settings.digest_max_messages}."
+        )
+        return
+
+    prompt = await prompt_service.prompt_registry.get(db, prompt_type)
+    if not prompt:
+        await event.reply(f"Тип промпта '{prompt_type}' не найден.")
+        return
+
+    subscription = await digests_service.subscribe(
+        db, event.chat_id, prompt.name, str(user.id), every_messages
+    )
+    message_store.tracked_chats.add(event.chat_id)
+    if every_messages:
+        await event.reply(
+            f"✅ Дайджест `{prompt.name}` будет приходить после каждых {every_messages} сообщений."
+        )
+    else:
+        await event.reply(
+            f"✅ Дайджест `{prompt.name}` будет приходить ежедневно, "
+            f"ближайший — {subscription.next_run_at:%Y-%m-%d %H:%M} UTC."
+        )
+
+
+@bot.on(events.NewMessage(pattern="/unsubscribe"))
+@get_db
+async def unsubscribe(event, db: AsyncSession = None):
+    parts = shlex.split(event.message.text)
+    prompt_type = parts[1] if len(parts) > 1 else None
+    if await digests_service.unsubscribe(db, event.chat_id, prompt_type):
+        await event.reply("Подписка на дайджест отменена.")
+    else:
+        await event.reply("Подписок на дайджест в этом чате не найдено.")
+
+
+async def serve(handle_signals: bool = False):
+    global bot_loop, shutdown_event
+    bot_loop = asyncio.get_running_loop()
+    shutdown_event = asyncio.Event()
+    if handle_signals:
+        add_shutdown_signal_handlers(shutdown_event)
+
+    if not await wait_first(acquire_leader_locks(), shutdown_event.wait()):
+        await release_leader_locks()
+        await dispose_engine()
+        return
+
+    metrics_server = None
+    try:
+        # The bot may be started before the web app, or after an upgrade that
+        # added columns; schema sync is idempotent.
+        await init_db()
+        if settings.bot_metrics_port and not settings.embedded_bot:
+            metrics_server = await metrics.start_metrics_server(
+                settings.bot_metrics_host, settings.bot_metrics_port
+            )
+        async with SessionLocal() as db:
+            await message_store.load_tracked_chats(db)
+            await rate_limiter.load(db)
+
+        await bot.start()
+        logger.info("Клиент Telegram запущен (режим пользователя)...")
+        await worker_pool.start()
+        await digest_scheduler.start()
+        await retention_scheduler.start()
+        await wait_first(
+            shutdown_event.wait(),
+            bot.wait_disconnected(),
+            *(lock.wait_lost() for lock in leader_locks),
+        )
+    finally:
+        logger.info("Остановка Telegram-бота...")
+        if metrics_server is not None:
+            metrics_server.close()
+        await digest_scheduler.stop()
+        await retention_scheduler.stop()
+        await worker_pool.stop(settings.shutdown_grace_seconds)
+        await bot.disconnect()
+        await close_openai_client()
+        await release_leader_locks()
+        await dispose_engine()
+
+
+async def acquire_leader_locks():
+    for lock in leader_locks:
+        await lock.acquire()
+
+
+async def release_leader_locks():
+    for lock in leader_locks:
+        await lock.release()
+
+
+async def wait_first(main, *stop_conditions) -> bool:
+    # Runs main until it or any of stop_conditions finishes; True means main
+    # finished first.
+    main_task = asyncio.ensure_future(main)
+    others = [asyncio.ensure_future(condition) for condition in stop_conditions]
+    try:
+        await asyncio.wait([main_task, *others], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in [main_task, *others]:
+            task.cancel()
+    if main_task.done() and not main_task.cancelled():
+        main_task.result()
+        return True
+    return False
+
+
+def request_shutdown():
+    # Called from another thread when the bot runs embedded in the web app.
+    if bot_loop is not None and shutdown_event is not None:
+        bot_loop.call_soon_threadsafe(shutdown_event.set)
 
 
 def run_bot():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve())
 
-    async def main():
-        await bot.start()
-        logger.info("Клиент Telegram запущен (режим пользователя)...")
-        await bot.run_until_disconnected()
 
-    loop.run_until_complete(main())
+if __name__ == "__main__":
+    asyncio.run(serve(handle_signals=True))